@@ -0,0 +1,117 @@
+"""
+Micro-benchmark: _maybe_decode (escaneo completo) vs _NestedJsonDecoder (esquema aprendido).
+
+Uso (desde functions/, con el venv de las functions activado):
+    python bench/bench_decode.py                       # payload sintético tipo MAPA
+    python bench/bench_decode.py productos.json ...    # exports grabados (curl/Postman)
+    python bench/bench_decode.py --items 50000 --repeat 5
+
+Para cada payload mide los items/s de ambos decodificadores sobre copias frescas
+de los items (el decodificador por esquema trabaja en sitio) y comprueba que el
+resultado es idéntico.
+"""
+from __future__ import annotations
+
+import argparse
+import copy
+import gc
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+
+def synthetic_items(n: int) -> list:
+    """Items con la forma aproximada de ExportJsonProductos: algunos campos traen JSON en string."""
+    items = []
+    for i in range(n):
+        usos = [
+            {
+                "Cultivo": f"Cultivo {j}",
+                "Plagas": json.dumps([{"Nombre": f"Plaga {k}", "Dosis": "1-2 l/ha"} for k in range(3)]),
+                "PlazoSeguridad": j * 7,
+            }
+            for j in range(4)
+        ]
+        items.append({
+            "NumRegistro": f"ES-{i:05d}",
+            "NombreComercial": f"Producto {i}",
+            "Titular": "Titular S.A.",
+            "Formulado": "Glifosato 36% [SL] P/V",
+            "Estado": "Vigente",
+            "FechaInscripcion": "2001-05-17",
+            "Observaciones": "[ver etiqueta] uso profesional",
+            "Sustancias": json.dumps([{"Nombre": "glifosato", "Riqueza": "36%"}]),
+            "Usos": json.dumps(usos),
+        })
+    return items
+
+
+def load_items(path: str) -> list:
+    with open(path, encoding="utf-8") as fh:
+        payload = json.load(fh)
+    if isinstance(payload, str):
+        payload = main._maybe_decode(payload)
+    return main._extract_items(payload)
+
+
+def bench(name: str, items: list, repeat: int) -> None:
+    copies = [copy.deepcopy(items) for _ in range(repeat * 2 + 1)]
+    # Como timeit: sin GC durante las mediciones (las copias inflan el heap y
+    # el coste del recolector taparía la diferencia entre decodificadores)
+    gc.collect()
+    gc.disable()
+    try:
+        _bench(name, items, copies, repeat)
+    finally:
+        gc.enable()
+
+
+def _bench(name: str, items: list, copies: list, repeat: int) -> None:
+    t_full = []
+    for _ in range(repeat):
+        batch = copies.pop()
+        t0 = time.perf_counter()
+        expected = [main._maybe_decode(it) for it in batch]
+        t_full.append(time.perf_counter() - t0)
+
+    # Primera pasada: aprende el esquema (igual que la primera ejecución en producción)
+    learner = main._NestedJsonDecoder()
+    for it in copies.pop():
+        learner.decode(it)
+
+    t_schema = []
+    for _ in range(repeat):
+        batch = copies.pop()
+        decoder = main._NestedJsonDecoder(learner.paths)
+        t0 = time.perf_counter()
+        got = [decoder.decode(it) for it in batch]
+        t_schema.append(time.perf_counter() - t0)
+
+    full, schema = min(t_full), min(t_schema)
+    n = len(items)
+    print(f"{name}: {n} items, {len(learner.paths)} rutas con JSON anidado")
+    print(f"  _maybe_decode       {full * 1000:9.1f} ms  {n / full:12,.0f} items/s")
+    print(f"  _NestedJsonDecoder  {schema * 1000:9.1f} ms  {n / schema:12,.0f} items/s  (x{full / schema:.2f})")
+    print(f"  resultado idéntico: {got == expected}  reescaneos: {decoder.rescans}")
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("payloads", nargs="*", help="ficheros JSON grabados de los exports")
+    parser.add_argument("--items", type=int, default=20000, help="items del payload sintético")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if not args.payloads:
+        bench("sintético", synthetic_items(args.items), args.repeat)
+    for path in args.payloads:
+        bench(os.path.basename(path), load_items(path), args.repeat)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,313 @@
+"""
+Benchmark de la ingesta completa: un servidor HTTP local hace de MAPA y AEMET y un
+Firestore en memoria (bench/fakefs.py) recibe las escrituras.
+
+Uso (desde functions/, con el venv de las functions activado):
+    python bench/bench_ingest.py                           # payloads sintéticos
+    python bench/bench_ingest.py --payloads grabados/      # {endpoint}.json y aemet_{CCAA}.json grabados
+    python bench/bench_ingest.py --scale 10 --commit-latency-ms 30
+    python bench/bench_ingest.py --save base.json          # guarda el resultado como referencia
+    python bench/bench_ingest.py --baseline base.json      # exit 1 si los items/s caen más de --max-regression
+
+Cada repetición parte de una base de datos vacía y ejecuta run_snapshot tres veces:
+  1. initial    -> todos los items son nuevos
+  2. changed    -> un --change de los items cambia
+  3. unchanged  -> export idéntico: debe cortarse por huella sin escribir nada
+y después el pre-calentado de AEMET para todas las CCAA (segundo salto 'datos' incluido).
+Con --scale N cada export se replica N veces (IDs distintos) para ensayar exports mayores.
+De cada fase se queda la mejor repetición; las métricas son las que guarda
+_snapshot_endpoint en el snapshot (etapas, bytes, items/s, latencia de commit, RSS).
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import copy
+import gc
+import io
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+from bench_decode import synthetic_items  # noqa: E402
+from fakefs import FakeFirestore  # noqa: E402
+
+# Tamaño aproximado de los exports actuales (con --payloads se usan los reales)
+SYNTHETIC_ITEMS = {"productos": 3500, "formulados": 1200, "sustancias": 600, "cultivos": 900}
+PHASES = ("initial", "changed", "unchanged")
+
+
+def synthetic_export(name: str, n: int) -> list:
+    if name == "productos":
+        return synthetic_items(n)
+    key = {"formulados": "IdFormulado", "sustancias": "IdSustancia", "cultivos": "CodigoEppo"}.get(name, "Id")
+    return [
+        {key: f"{name[:3].upper()}{i:06d}", "Nombre": f"{name} {i}", "Estado": "Vigente",
+         "Detalle": json.dumps({"Orden": i, "Notas": ["a", "b"]})}
+        for i in range(n)
+    ]
+
+
+def load_export(path: str) -> list:
+    with open(path, encoding="utf-8") as fh:
+        payload = main._maybe_decode(json.load(fh))
+    return main._extract_items(payload)
+
+
+def scale_items(items: list, ep: dict, scale: int) -> list:
+    """Replica los items 'scale' veces cambiando la clave natural de cada copia."""
+    out = list(items)
+    fields = {f.lower() for f in ep.get("id_fields") or ()}
+    for k in range(1, scale):
+        for item in items:
+            if not isinstance(item, dict):
+                out.append(item)
+                continue
+            clone = dict(item)
+            for key, val in item.items():
+                if key.lower() in fields and val is not None and not isinstance(val, (dict, list)):
+                    clone[key] = f"{val}#{k}"
+            clone.setdefault("_copia", k)
+            out.append(clone)
+    return out
+
+
+def change_items(items: list, fraction: float, tag: int) -> list:
+    step = max(1, round(1 / fraction)) if fraction > 0 else 0
+    out = []
+    for i, item in enumerate(items):
+        if step and i % step == 0 and isinstance(item, dict):
+            item = {**item, "_bench": tag}
+        out.append(item)
+    return out
+
+
+class _Upstream:
+    """Servidor local: /mapa/{endpoint}, /aemet/{CCAA} y /aemet-datos/{CCAA}."""
+
+    def __init__(self) -> None:
+        self.bodies: dict = {}
+        self.requests = 0
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._reply()
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                self._reply()
+
+            def _reply(self):
+                owner.requests += 1
+                path = self.path.split("?", 1)[0]
+                if path.startswith("/aemet/"):
+                    ccaa = path.rsplit("/", 1)[-1]
+                    body = json.dumps({"estado": 200, "datos": f"{owner.base}/aemet-datos/{ccaa}"}).encode()
+                else:
+                    body = owner.bodies.get(path)
+                if body is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+
+
+def _phase_metrics(totals: list, wall: float) -> dict:
+    out = {"wallSec": round(wall, 3), "endpoints": {}}
+    for result in totals:
+        m = result.get("metrics") or {}
+        out["endpoints"][result["endpoint"]] = {
+            "items": result.get("itemsCount"),
+            "skipped": bool(result.get("skipped")),
+            "writes": result.get("writesCount"),
+            "wallSec": m.get("wallSec"),
+            "itemsPerSec": m.get("itemsPerSec"),
+            "stagesSec": m.get("stagesSec"),
+            "bytesDownloaded": (m.get("counters") or {}).get("bytesDownloaded"),
+            "commitLatencyMs": m.get("commitLatencyMs"),
+            "rssMb": m.get("rssMb"),
+            "rssDeltaMb": m.get("rssDeltaMb"),
+            "processPeakRssMb": m.get("processPeakRssMb"),
+        }
+    return out
+
+
+def run_once(upstream: _Upstream, endpoints: list, exports: dict, change: float, aemet: list, latency: float) -> dict:
+    db = FakeFirestore(commit_latency=latency)
+    main._get_db = lambda: db
+    main.TASKS_INLINE = True  # la tarea del índice de búsqueda se ejecuta aquí mismo
+    main._schema_cache.clear()
+    main._aemet_mem.clear()
+
+    out = {}
+    for phase in PHASES:
+        for ep in endpoints:
+            items = exports[ep["name"]]
+            if phase != "initial":
+                items = change_items(items, change, 1)
+            upstream.bodies[f"/mapa/{ep['name']}"] = json.dumps({"Contenido": items}, ensure_ascii=False).encode()
+        gc.collect()
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # prints de _post_ingest
+            totals, errors = main.run_snapshot(endpoints)
+        out[phase] = _phase_metrics(totals, time.perf_counter() - t0)
+        if errors:
+            out[phase]["errors"] = errors
+        time.sleep(0.002)  # createdAt distinto entre fases
+
+    if aemet:
+        t0 = time.perf_counter()
+        run = main.prewarm_aemet(aemet, "bench")
+        out["aemet"] = {"wallSec": round(time.perf_counter() - t0, 3), "ok": run["okCount"], "failed": run["failedCount"]}
+    return out
+
+
+def best_of(runs: list) -> dict:
+    """Mejor repetición por fase (menor tiempo total)."""
+    best = {}
+    for key in (*PHASES, "aemet"):
+        candidates = [r[key] for r in runs if key in r]
+        if candidates:
+            best[key] = min(candidates, key=lambda r: r["wallSec"])
+    return best
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> list:
+    failures = []
+    if baseline.get("scale") != result.get("scale"):
+        print(f"aviso: la referencia es de --scale {baseline.get('scale')}, esta ejecución de {result.get('scale')}")
+    for phase in ("initial", "changed"):
+        for name, cur in result["phases"].get(phase, {}).get("endpoints", {}).items():
+            ref = baseline["phases"].get(phase, {}).get("endpoints", {}).get(name) or {}
+            if not ref.get("itemsPerSec") or not cur.get("itemsPerSec"):
+                continue
+            drop = 1 - cur["itemsPerSec"] / ref["itemsPerSec"]
+            if drop > max_regression:
+                failures.append(f"{phase}/{name}: {ref['itemsPerSec']:,.0f} -> {cur['itemsPerSec']:,.0f} items/s (-{drop:.0%})")
+    ref_aemet = baseline["phases"].get("aemet", {}).get("wallSec")
+    cur_aemet = result["phases"].get("aemet", {}).get("wallSec")
+    if ref_aemet and cur_aemet and cur_aemet / ref_aemet - 1 > max_regression:
+        failures.append(f"aemet: {ref_aemet:.3f}s -> {cur_aemet:.3f}s")
+    return failures
+
+
+def report(result: dict) -> None:
+    for phase in PHASES:
+        data = result["phases"].get(phase)
+        if not data:
+            continue
+        print(f"{phase}: {data['wallSec'] * 1000:,.0f} ms (run_snapshot completo)")
+        for name, m in data["endpoints"].items():
+            if m["skipped"]:
+                print(f"  {name:<11} sin cambios, corte por huella en {m['wallSec'] * 1000:,.1f} ms")
+                continue
+            stages = " ".join(f"{k}={v * 1000:.0f}" for k, v in (m["stagesSec"] or {}).items())
+            p95 = (m["commitLatencyMs"] or {}).get("p95")
+            print(
+                f"  {name:<11} {m['items']:>8,} items {m['itemsPerSec'] or 0:>10,.0f} items/s  "
+                f"{(m['bytesDownloaded'] or 0) / 1e6:6.1f} MB  commit p95 {p95} ms  "
+                f"RSS {m['rssMb']} MB (Δ {m['rssDeltaMb']} MB, pico del proceso {m['processPeakRssMb']} MB)"
+            )
+            print(f"  {'':<11} etapas (ms): {stages}")
+    if "aemet" in result["phases"]:
+        a = result["phases"]["aemet"]
+        print(f"aemet: {a['ok']} CCAA en {a['wallSec'] * 1000:,.0f} ms ({a['failed']} fallos)")
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--payloads", help="directorio con {endpoint}.json y aemet_{CCAA}.json grabados")
+    parser.add_argument("--scale", type=int, default=1, help="multiplica el tamaño de cada export (1-10)")
+    parser.add_argument("--change", type=float, default=0.05, help="fracción de items cambiados en la fase 'changed'")
+    parser.add_argument("--commit-latency-ms", type=float, default=20.0, help="latencia simulada por commit")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", help="guarda el resultado en este fichero JSON")
+    parser.add_argument("--baseline", help="resultado de referencia (--save) contra el que comparar")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="caída máxima admitida de items/s")
+    args = parser.parse_args()
+    if not 1 <= args.scale <= 10:
+        parser.error("--scale debe estar entre 1 y 10")
+
+    # Los logs estructurados por invocación ensucian la salida del benchmark
+    main._log = lambda *a, **k: None
+
+    upstream = _Upstream()
+    endpoints = []
+    exports = {}
+    for ep in main.ENDPOINTS:
+        ep = copy.deepcopy(ep)
+        ep["url"] = f"{upstream.base}/mapa/{ep['name']}"
+        path = os.path.join(args.payloads, f"{ep['name']}.json") if args.payloads else None
+        if path and os.path.exists(path):
+            items = load_export(path)
+        else:
+            items = synthetic_export(ep["name"], SYNTHETIC_ITEMS.get(ep["name"], 1000))
+        exports[ep["name"]] = scale_items(items, ep, args.scale)
+        endpoints.append(ep)
+
+    aemet = list(main.AEMET_CCAA)
+    main.AEMET_BASE = f"{upstream.base}/aemet"
+    for ccaa in aemet:
+        path = os.path.join(args.payloads, f"aemet_{ccaa}.json") if args.payloads else None
+        if path and os.path.exists(path):
+            with open(path, "rb") as fh:
+                body = fh.read()
+        else:
+            body = json.dumps([{"nombre": ccaa, "prediccion": {"dia": [{"texto": "Cielos despejados. " * 50}]}}]).encode()
+        upstream.bodies[f"/aemet-datos/{ccaa}"] = body
+
+    try:
+        runs = [
+            run_once(upstream, endpoints, exports, args.change, aemet, args.commit_latency_ms / 1000)
+            for _ in range(args.repeat)
+        ]
+    finally:
+        upstream.close()
+
+    result = {
+        "scale": args.scale,
+        "items": {name: len(items) for name, items in exports.items()},
+        "commitLatencyMs": args.commit_latency_ms,
+        "phases": best_of(runs),
+    }
+    report(result)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as fh:
+            json.dump(result, fh, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fh:
+            failures = compare(result, json.load(fh), args.max_regression)
+        for failure in failures:
+            print(f"REGRESIÓN {failure}")
+        if failures:
+            sys.exit(1)
+        print(f"sin regresiones (umbral {args.max_regression:.0%})")
+
+
+if __name__ == "__main__":
+    main_cli()
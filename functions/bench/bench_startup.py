@@ -0,0 +1,166 @@
+"""
+Arranque en frío por función: tiempo de 'import main' y latencia de la primera
+petición (y de la segunda, ya en caliente), cada medida en un proceso nuevo.
+
+Uso (desde functions/, con el venv de las functions activado):
+    python bench/bench_startup.py                 # 5 arranques por función
+    python bench/bench_startup.py --runs 15
+
+AEMET se sirve desde un servidor local y Firestore es el falso de bench/fakefs.py,
+pero la primera llamada a _get_db importa firebase_admin.firestore de verdad, así
+que su coste cuenta donde se pague en producción. "framework" es el suelo: solo
+los imports de firebase_functions que hace cualquier función.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Petición de prueba por función HTTP de lectura (las de ingesta son batch: el
+# arranque en frío no se nota frente a la ejecución)
+TARGETS = {
+    "aemet_ccaa_hoy": {"path": "/aemet/ccaa/MAD", "query": ""},
+    "regfi_search": {"path": "/", "query": "q=producto&limit=5"},
+}
+WATCH = ("google.cloud.firestore", "grpc", "requests")
+
+
+def _loaded() -> dict:
+    return {name: name in sys.modules for name in WATCH}
+
+
+def _aemet_stub() -> str:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.startswith("/aemet/"):
+                body = json.dumps({"estado": 200, "datos": f"{base}/datos"}).encode()
+            else:
+                body = json.dumps([{"nombre": "Madrid", "texto": "Cielos despejados."}]).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    base = f"http://127.0.0.1:{server.server_port}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return base
+
+
+def child(target: str) -> dict:
+    """Se ejecuta en un proceso nuevo: mide import + primera y segunda petición."""
+    if target == "framework":
+        t0 = time.perf_counter()
+        from firebase_functions import https_fn, scheduler_fn, tasks_fn  # noqa: F401
+        from firebase_functions import options  # noqa: F401
+        return {"importMs": (time.perf_counter() - t0) * 1000, "loaded": _loaded()}
+
+    sys.path.insert(0, os.path.join(HERE, ".."))
+    sys.path.insert(0, HERE)
+    os.environ["AEMET_API_KEY"] = "bench"
+
+    t0 = time.perf_counter()
+    import main
+    import_ms = (time.perf_counter() - t0) * 1000
+    loaded_after_import = _loaded()
+
+    # Preparación (no cuenta): upstream local y Firestore falso con índice publicado
+    from fakefs import FakeFirestore
+    from werkzeug.test import EnvironBuilder
+    from flask import Request
+
+    db = FakeFirestore()
+    if target == "regfi_search":
+        for ep in main._endpoints():
+            for i in range(200):
+                db.collection(ep["collection"]).document(f"{i}").set(
+                    {"data": {"NombreComercial": f"Producto {i}", "Nombre": f"Producto {i}"}, "removedAt": None}
+                )
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                main.build_search_index(db, main._endpoints())
+            finally:
+                sys.stdout = stdout
+        main._regfi_config = None  # que la petición lo encuentre como en un arranque real
+
+    def get_db():
+        from firebase_admin import firestore  # noqa: F401  (coste real del import)
+        return db
+
+    main._get_db = get_db
+    main.AEMET_BASE = f"{_aemet_stub()}/aemet"
+    handler = getattr(main, target)
+    spec = TARGETS[target]
+
+    def request() -> float:
+        req = EnvironBuilder(path=spec["path"], query_string=spec["query"]).get_request(cls=Request)
+        t = time.perf_counter()
+        resp = handler(req)
+        elapsed = (time.perf_counter() - t) * 1000
+        if resp.status_code >= 400:
+            raise RuntimeError(f"{target}: HTTP {resp.status_code} {resp.get_data(as_text=True)[:200]}")
+        return elapsed
+
+    first_ms = request()
+    warm_ms = request()
+    return {
+        "importMs": import_ms,
+        "firstMs": first_ms,
+        "warmMs": warm_ms,
+        "loaded": loaded_after_import,
+    }
+
+
+def run(target: str, runs: int) -> dict:
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", target],
+            capture_output=True, text=True, check=True,
+        )
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    result = {"loaded": samples[-1]["loaded"]}
+    for key in ("importMs", "firstMs", "warmMs"):
+        values = [s[key] for s in samples if key in s]
+        if values:
+            result[key] = statistics.median(values)
+    return result
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="arranques por función (se da la mediana)")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args.child)))
+        return
+
+    print(f"mediana de {args.runs} arranques (ms)")
+    print(f"{'función':<16} {'import':>8} {'1ª pet.':>8} {'2ª pet.':>8}  cargado tras el import")
+    for target in ("framework", *TARGETS):
+        r = run(target, args.runs)
+        loaded = ", ".join(name for name, ok in r["loaded"].items() if ok) or "-"
+        first = f"{r['firstMs']:8.1f}" if "firstMs" in r else f"{'':>8}"
+        warm = f"{r['warmMs']:8.1f}" if "warmMs" in r else f"{'':>8}"
+        print(f"{target:<16} {r['importMs']:8.1f} {first} {warm}  {loaded}")
+
+
+if __name__ == "__main__":
+    main_cli()
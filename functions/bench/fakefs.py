@@ -0,0 +1,175 @@
+"""
+Firestore en memoria para los benchmarks (solo lo que usa main.py).
+
+No valida reglas ni índices: sirve para medir el camino de ingesta sin red. Con
+'commit_latency' cada commit de batch espera ese tiempo (segundos), para simular
+el viaje de ida y vuelta a Firestore y que el solapamiento de commits cuente.
+"""
+from __future__ import annotations
+
+import copy
+import threading
+import time
+import uuid
+
+from google.api_core.exceptions import AlreadyExists
+
+
+class _Snap:
+    def __init__(self, ref, data):
+        self.reference, self.id, self._data = ref, ref.id, data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class _Doc:
+    def __init__(self, db, path):
+        self._db, self.path = db, path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return _Col(self._db, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None):
+        with self._db._lock:
+            return _Snap(self, copy.deepcopy(self._db._docs.get(self.path)))
+
+    def set(self, data, merge=False):
+        self._db._apply(self.path, data, merge)
+
+    def create(self, data):
+        with self._db._lock:
+            if self.path in self._db._docs:
+                raise AlreadyExists(self.path)
+            self._db._docs[self.path] = copy.deepcopy(data)
+
+    def update(self, data):
+        self._db._apply(self.path, data, True)
+
+    def delete(self):
+        with self._db._lock:
+            self._db._docs.pop(self.path, None)
+
+
+class _Query:
+    _OPS = {
+        "==": lambda a, b: a == b,
+        "in": lambda a, b: a in b,
+        ">": lambda a, b: a is not None and a > b,
+        ">=": lambda a, b: a is not None and a >= b,
+        "<": lambda a, b: a is not None and a < b,
+    }
+
+    def __init__(self, db, path, filters=(), order=None, lim=None):
+        self._db, self._path = db, path
+        self._filters, self._order, self._limit = list(filters), order, lim
+
+    def where(self, field, op, value):
+        return _Query(self._db, self._path, self._filters + [(field, op, value)], self._order, self._limit)
+
+    def order_by(self, field, direction="ASCENDING"):
+        return _Query(self._db, self._path, self._filters, (field, direction), self._limit)
+
+    def limit(self, n):
+        return _Query(self._db, self._path, self._filters, self._order, n)
+
+    def select(self, fields):
+        return self
+
+    def stream(self):
+        prefix = self._path + "/"
+        with self._db._lock:
+            rows = [
+                (p, copy.deepcopy(d)) for p, d in self._db._docs.items()
+                if p.startswith(prefix) and "/" not in p[len(prefix):]
+            ]
+        rows = [(p, d) for p, d in rows if all(self._OPS[op](d.get(f), v) for f, op, v in self._filters)]
+        rows.sort(key=lambda r: r[0])
+        if self._order:
+            field, direction = self._order
+            rows.sort(key=lambda r: (r[1].get(field) is not None, r[1].get(field)), reverse=direction == "DESCENDING")
+        if self._limit is not None:
+            rows = rows[: self._limit]
+        for p, d in rows:
+            yield _Snap(_Doc(self._db, p), d)
+
+    def get(self):
+        return list(self.stream())
+
+
+class _Col(_Query):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, doc_id=None):
+        return _Doc(self._db, f"{self._path}/{doc_id or uuid.uuid4().hex[:20]}")
+
+
+class _Batch:
+    def __init__(self, db):
+        self._db, self._ops = db, []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append(("set", ref, data, merge))
+
+    def create(self, ref, data):
+        self._ops.append(("create", ref, data, False))
+
+    def update(self, ref, data):
+        self._ops.append(("set", ref, data, True))
+
+    def delete(self, ref):
+        self._ops.append(("delete", ref, None, False))
+
+    def commit(self):
+        if len(self._ops) > 500:
+            raise ValueError("Un batch admite como mucho 500 operaciones")
+        if self._db.commit_latency:
+            time.sleep(self._db.commit_latency)
+        for op, ref, data, merge in self._ops:
+            if op == "delete":
+                ref.delete()
+            elif op == "create":
+                ref.create(data)
+            else:
+                self._db._apply(ref.path, data, merge)
+        with self._db._lock:
+            self._db.commits += 1
+            self._db.writes += len(self._ops)
+
+
+class FakeFirestore:
+    def __init__(self, commit_latency: float = 0.0):
+        self._docs, self._lock = {}, threading.RLock()
+        self.commit_latency = commit_latency
+        self.commits = self.writes = 0
+
+    def _apply(self, path, data, merge):
+        with self._lock:
+            if merge and path in self._docs:
+                # merge=True o lista de campos: se sustituyen los campos de primer nivel
+                self._docs[path].update(copy.deepcopy(data))
+            else:
+                self._docs[path] = copy.deepcopy(data)
+
+    def collection(self, name):
+        return _Col(self, name)
+
+    def document(self, path):
+        return _Doc(self, path)
+
+    def batch(self):
+        return _Batch(self)
+
+    def get_all(self, refs, field_paths=None):
+        for ref in refs:
+            yield ref.get()
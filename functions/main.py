@@ -2,25 +2,145 @@ from __future__ import annotations
 
 import os
 import json
+import re
+import zlib
+import gzip
+import bisect
+import codecs
+import unicodedata
 import hashlib
-from datetime import datetime, timezone
-from typing import Any, Iterable, List, Dict, Optional
+import time
+import random
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from datetime import datetime, timezone, timedelta
+from urllib.parse import urlsplit
+from zoneinfo import ZoneInfo
+from typing import Any, Callable, Iterable, Iterator, List, Dict, Optional, Tuple, Union
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
 
-from firebase_functions import scheduler_fn, https_fn
-from firebase_functions.options import set_global_options
+from firebase_functions import scheduler_fn, https_fn, tasks_fn
+from firebase_functions.options import set_global_options, RetryConfig, RateLimits
 from firebase_admin import initialize_app
-from firebase_admin import firestore as admin_fs
+
+try:
+    import brotli  # opcional: sin él las respuestas solo se comprimen con gzip
+except ImportError:
+    brotli = None
 
 # ---------- Opciones globales ----------
+REGION = "europe-west1"
 set_global_options(
-    region="europe-west1",
+    region=REGION,
     max_instances=5,
     timeout_sec=120,
     secrets=["AEMET_API_KEY"]  # 👈 añade esto aquí
 )
 
+# ---------- Clientes HTTP hacia arriba (MAPA, AEMET) ----------
+# Una Session por host, reutilizada entre invocaciones del mismo contenedor:
+# conexiones keep-alive (sin TCP+TLS por petición), hasta "pool" conexiones abiertas
+# por host (sin esperar a que quede una libre: las peticiones de más usan una conexión
+# que se cierra al acabar, así que una respuesta sin cerrar no deja colgado el pool),
+# y reintentos de errores de conexión, 429 y 5xx con backoff exponencial
+# y jitter respetando Retry-After. "timeout" es (conexión, lectura) en segundos.
+# El peor caso está acotado: tras un timeout de lectura se reintenta como mucho
+# "read_retries" veces (la petición entera otra vez, lo caro), y no se empieza un
+# reintento si la espera más un intento completo (conexión + lectura) se pasaría de
+# "budget" segundos desde el envío. Una llamada tarda como mucho ~budget, a sumar
+# por salto en el timeout de la función que la hace.
+HTTP_DEFAULTS: Dict[str, Any] = {
+    "pool": 4, "timeout": (10, 60), "retries": 4, "read_retries": 1, "backoff": 1.0, "budget": 100,
+}
+HTTP_RETRY_STATUS = (429, 500, 502, 503, 504)
+# Dos saltos por región: ~60 s en el peor caso, dentro de los 120 s de aemet_ccaa_hoy
+AEMET_HTTP: Dict[str, Any] = {
+    "pool": 8, "timeout": (5, 15), "retries": 3, "read_retries": 1, "backoff": 0.5, "budget": 30,
+}
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+_http_local = threading.local()
+
+class _BudgetRetry(Retry):
+    """Retry que no reintenta si el siguiente intento acabaría después de 'budget'."""
+
+    budget: Optional[float] = None
+    attempt_sec: float = 0.0
+
+    def new(self, **kw: Any) -> "_BudgetRetry":
+        retry = super().new(**kw)
+        retry.budget, retry.attempt_sec = self.budget, self.attempt_sec
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        if self.budget is None:
+            return retry
+        wait = None
+        if response is not None and self.respect_retry_after_header:
+            wait = self.get_retry_after(response)
+        if wait is None:
+            wait = retry.get_backoff_time()
+        started = getattr(_http_local, "started", None) or time.monotonic()
+        if time.monotonic() - started + wait + self.attempt_sec > self.budget:
+            # Como al agotar 'total': con raise_on_status=False urllib3 devuelve la respuesta
+            raise MaxRetryError(_pool, url, error or ResponseError(f"sin tiempo para reintentar en {self.budget:g} s")) from error
+        return retry
+
+class _BudgetAdapter(HTTPAdapter):
+    """Anota cuándo empieza cada envío (en el hilo que lo hace) para _BudgetRetry."""
+
+    def send(self, request, *args: Any, **kwargs: Any):
+        _http_local.started = time.monotonic()
+        return super().send(request, *args, **kwargs)
+
+def _http_retry(cfg: Dict[str, Any]) -> Retry:
+    kwargs = dict(
+        total=cfg["retries"],
+        read=cfg["read_retries"],
+        backoff_factor=cfg["backoff"],
+        status_forcelist=HTTP_RETRY_STATUS,
+        allowed_methods=None,  # también POST: los exports del MAPA son consultas sin efectos
+        respect_retry_after_header=True,
+        raise_on_status=False,  # agotados los reintentos, raise_for_status() da el error HTTP real
+    )
+    try:
+        retry = _BudgetRetry(backoff_jitter=cfg["backoff"], **kwargs)
+    except TypeError:  # urllib3 < 2 no tiene jitter
+        retry = _BudgetRetry(**kwargs)
+    connect, read = cfg["timeout"] if isinstance(cfg["timeout"], tuple) else (cfg["timeout"],) * 2
+    retry.budget, retry.attempt_sec = cfg.get("budget"), connect + read
+    return retry
+
+def _http_config(cfg: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    return {**HTTP_DEFAULTS, **(cfg or {})}
+
+def _http_session(url: str, cfg: Optional[Dict[str, Any]] = None) -> requests.Session:
+    """Session compartida para el host de 'url' (la config del primero que la crea manda)."""
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            cfg = _http_config(cfg)
+            adapter = _BudgetAdapter(
+                pool_connections=1,
+                pool_maxsize=cfg["pool"],
+                pool_block=False,
+                max_retries=_http_retry(cfg),
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Accept-Encoding"] = "gzip, deflate"
+            _sessions[host] = session
+    return session
+
 # ---------- AEMET: predicción por CCAA (hoy) ----------
 AEMET_BASE = "https://opendata.aemet.es/opendata/api/prediccion/ccaa/hoy"
 # ---------- AEMET helpers ----------
@@ -68,11 +188,12 @@ def _fetch_aemet_ccaa_hoy(ccaa: str, api_key: str) -> dict:
     """
     # Primer salto: metadatos con URL de descarga
     url = f"{AEMET_BASE}/{ccaa}"
-    r1 = requests.get(
+    timeout = _http_config(AEMET_HTTP)["timeout"]
+    r1 = _http_session(url, AEMET_HTTP).get(
         url,
         params={"api_key": api_key},
         headers={"cache-control": "no-cache"},
-        timeout=30,
+        timeout=timeout,
     )
     r1.raise_for_status()
     meta = r1.json()
@@ -81,7 +202,7 @@ def _fetch_aemet_ccaa_hoy(ccaa: str, api_key: str) -> dict:
         raise RuntimeError(f"Respuesta AEMET sin 'datos': {meta}")
 
     # Segundo salto: descarga real
-    r2 = requests.get(datos_url, timeout=30)
+    r2 = _http_session(datos_url, AEMET_HTTP).get(datos_url, timeout=timeout)
     r2.raise_for_status()
     try:
         payload = r2.json()
@@ -98,21 +219,423 @@ def _fetch_aemet_ccaa_hoy(ccaa: str, api_key: str) -> dict:
     else:
         return {"ccaa": ccaa, "data": payload, "source": url}
     
-def _cors_response(body: str, status: int = 200, mimetype: str = "application/json") -> https_fn.Response:
+def _cors_response(
+    body: Union[str, bytes],
+    status: int = 200,
+    mimetype: str = "application/json",
+    headers: Optional[Dict[str, str]] = None,
+) -> https_fn.Response:
     resp = https_fn.Response(body, status=status, mimetype=mimetype)
     resp.headers["Access-Control-Allow-Origin"] = "*"
     resp.headers["Access-Control-Allow-Methods"] = "GET, OPTIONS"
-    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, If-None-Match"
+    resp.headers["Access-Control-Expose-Headers"] = "ETag, X-Cache, Server-Timing"
+    for name, value in (headers or {}).items():
+        resp.headers[name] = value
+    return resp
+
+# ---------- Respuestas HTTP: compresión, ETag y caché ----------
+# Todas las funciones HTTP responden con _http_response:
+#   - ETag fuerte: sha256 del cuerpo sin comprimir, con sufijo por codificación
+#     ("<hash>-gzip", "<hash>-br") porque cada representación es distinta byte a byte.
+#   - If-None-Match que coincide con el hash (con o sin sufijo, o W/ si el CDN lo
+#     debilitó) -> 304 sin cuerpo.
+#   - gzip/br según Accept-Encoding (br solo si está instalado 'brotli').
+#   - Cache-Control por endpoint: (max-age, s-maxage); s-maxage lo usa el CDN de
+#     Hosting. Errores y respuestas sin 'cache' -> no-store.
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+def _accepted_encodings(req: https_fn.Request) -> Dict[str, float]:
+    accepted: Dict[str, float] = {}
+    for part in (req.headers.get("Accept-Encoding") or "").split(","):
+        token, _, params = part.partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[token] = q
+    return accepted
+
+def _pick_encoding(req: https_fn.Request) -> Optional[str]:
+    """Codificación con mayor q; a igualdad, br antes que gzip."""
+    accepted = _accepted_encodings(req)
+    best: Optional[str] = None
+    best_q = 0.0
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+def _etag_matches(if_none_match: str, digest: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        if tag == digest or tag.startswith(digest + "-"):
+            return True
+    return False
+
+def _http_response(
+    req: https_fn.Request,
+    body: str,
+    status: int = 200,
+    mimetype: str = "application/json",
+    headers: Optional[Dict[str, str]] = None,
+    cache: Optional[Tuple[int, int]] = None,
+    cors: bool = True,
+) -> https_fn.Response:
+    """Respuesta negociada (ver cabecera de la sección). 'cache' = (max-age, s-maxage) en segundos."""
+    raw = body.encode("utf-8")
+    out = dict(headers or {})
+    out["Vary"] = "Accept-Encoding"
+    if cache is not None and status == 200:
+        max_age, s_maxage = (max(0, int(v)) for v in cache)
+        out["Cache-Control"] = f"public, max-age={max_age}, s-maxage={s_maxage}"
+    else:
+        out["Cache-Control"] = "no-store"
+
+    encoding = _pick_encoding(req) if len(raw) >= COMPRESS_MIN_BYTES else None
+    if status == 200:
+        digest = hashlib.sha256(raw).hexdigest()[:32]
+        out["ETag"] = f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+        if_none_match = req.headers.get("If-None-Match")
+        if if_none_match and _etag_matches(if_none_match, digest):
+            status, raw, encoding = 304, b"", None
+    if encoding == "br":
+        raw = brotli.compress(raw, quality=BROTLI_QUALITY)
+    elif encoding == "gzip":
+        raw = gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding:
+        out["Content-Encoding"] = encoding
+
+    if cors:
+        return _cors_response(raw, status=status, mimetype=mimetype, headers=out)
+    resp = https_fn.Response(raw, status=status, mimetype=mimetype)
+    for name, value in out.items():
+        resp.headers[name] = value
     return resp
-# Inicializa Admin SDK una vez por contenedor
+# Inicializa Admin SDK una vez por contenedor. El cliente de Firestore (y su pila
+# gRPC) se importa aquí, en el primer uso: las funciones que no lo tocan no lo pagan
+# en el arranque en frío.
 _app = None
+_app_lock = threading.Lock()
+
 def _get_db():
     global _app
-    if _app is None:
-        _app = initialize_app()
+    from firebase_admin import firestore as admin_fs
+
+    # La ingesta y el batch de AEMET llaman aquí desde varios hilos a la vez en frío
+    with _app_lock:
+        if _app is None:
+            _app = initialize_app()
     return admin_fs.client()
 
+# ---------- AEMET: caché de dos niveles ----------
+# 1) Memoria del contenedor  2) Firestore 'aemet_cache/{CCAA}_{fecha}' (compartida).
+# Dentro de AEMET_CACHE_TTL_SEC (o del TTL con el que la guardó el pre-calentado)
+# se sirve sin ir a AEMET; hasta AEMET_CACHE_MAX_STALE_SEC
+# se sirve la copia vieja y se refresca en segundo plano (stale-while-revalidate),
+# y si AEMET falla se devuelve la última copia buena que haya.
+# En memoria solo quedan las claves del día más reciente (al guardar una se tiran las de
+# días anteriores), y mientras hay una descarga de la clave en curso no se mira Firestore:
+# la copia que traiga esa descarga es la que sirve.
+AEMET_CACHE_TTL_SEC = int(os.getenv("AEMET_CACHE_TTL_SEC", "1800"))
+AEMET_CACHE_MAX_STALE_SEC = int(os.getenv("AEMET_CACHE_MAX_STALE_SEC", "86400"))
+AEMET_CACHE_COLLECTION = "aemet_cache"
+_MADRID = ZoneInfo("Europe/Madrid")
+
+_aemet_mem: Dict[str, Dict[str, Any]] = {}   # clave -> {"fetchedAt", "expiresAt" (epoch), "data"}
+_aemet_inflight: Dict[str, Future] = {}       # clave -> descarga en curso (single-flight)
+_aemet_lock = threading.Lock()
+_aemet_refresh_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="aemet-refresh")
+
+def _aemet_cache_key(ccaa: str, day: Optional[datetime] = None) -> str:
+    day = day or datetime.now(_MADRID)
+    return f"{ccaa}_{day.date().isoformat()}"
+
+def _aemet_mem_set(key: str, entry: Dict[str, Any]) -> None:
+    """Guarda en memoria y tira las claves de fechas anteriores (ya no son 'hoy')."""
+    day = key.rsplit("_", 1)[-1]
+    with _aemet_lock:
+        for old in [k for k in _aemet_mem if k.rsplit("_", 1)[-1] < day]:
+            del _aemet_mem[old]
+        _aemet_mem[key] = entry
+
+def _aemet_cache_get(key: str, shared: bool = True) -> Optional[Dict[str, Any]]:
+    """Entrada de caché {"fetchedAt", "expiresAt", "data"}: primero memoria y, si no está fresca, Firestore."""
+    entry = _aemet_mem.get(key)
+    if entry is not None and time.time() < entry["expiresAt"]:
+        return entry
+    with _aemet_lock:
+        fetching = key in _aemet_inflight
+    if not shared or fetching:
+        return entry
+    try:
+        snap = _get_db().collection(AEMET_CACHE_COLLECTION).document(key).get()
+    except Exception as e:
+        print(f"[aemet][cache] lectura Firestore fallida {key}: {e}")
+        return entry
+    if not snap.exists:
+        return entry
+    doc = snap.to_dict() or {}
+    fetched_at = float(doc.get("fetchedAt") or 0)
+    stored = {
+        "fetchedAt": fetched_at,
+        "expiresAt": float(doc.get("expiresAt") or fetched_at + AEMET_CACHE_TTL_SEC),
+        "data": json.loads(doc.get("body") or "null"),
+    }
+    if entry is None or stored["fetchedAt"] > entry["fetchedAt"]:
+        _aemet_mem_set(key, stored)
+        entry = stored
+    return entry
+
+def _aemet_cache_put(
+    key: str,
+    ccaa: str,
+    data: dict,
+    ttl: Optional[int] = None,
+    fetched_at: Optional[float] = None,
+) -> Dict[str, Any]:
+    now = fetched_at or time.time()
+    entry = {"fetchedAt": now, "expiresAt": now + (ttl or AEMET_CACHE_TTL_SEC), "data": data}
+    _aemet_mem_set(key, entry)
+    try:
+        # El cuerpo va como string: AEMET puede traer arrays anidados que Firestore no admite
+        _get_db().collection(AEMET_CACHE_COLLECTION).document(key).set({
+            "ccaa": ccaa,
+            "fecha": key.rsplit("_", 1)[-1],
+            "fetchedAt": entry["fetchedAt"],
+            "expiresAt": entry["expiresAt"],
+            "updatedAt": _utc_now_iso(),
+            "body": json.dumps(data, ensure_ascii=False),
+        })
+    except Exception as e:
+        print(f"[aemet][cache] escritura Firestore fallida {key}: {e}")
+    return entry
+
+def _aemet_fetch_once(key: str, ccaa: str, api_key: str, ttl: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Single-flight: si ya hay una descarga de esta clave en curso en el contenedor,
+    espera a su resultado en vez de lanzar otra contra AEMET. Si quien espera pide un
+    'ttl' más largo (el pre-calentado), se alarga la entrada que ha dejado la descarga.
+    """
+    with _aemet_lock:
+        fut = _aemet_inflight.get(key)
+        leader = fut is None
+        if leader:
+            fut = _aemet_inflight[key] = Future()
+    if not leader:
+        entry = fut.result()
+        if ttl and entry["expiresAt"] < entry["fetchedAt"] + ttl:
+            entry = _aemet_cache_put(key, ccaa, entry["data"], ttl, fetched_at=entry["fetchedAt"])
+        return entry
+    try:
+        entry = _aemet_cache_put(key, ccaa, _fetch_aemet_ccaa_hoy(ccaa, api_key), ttl)
+        fut.set_result(entry)
+        return entry
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _aemet_lock:
+            _aemet_inflight.pop(key, None)
+
+def _aemet_refresh_in_background(key: str, ccaa: str, api_key: str) -> None:
+    def run() -> None:
+        try:
+            _aemet_fetch_once(key, ccaa, api_key)
+        except Exception as e:
+            print(f"[aemet][cache] refresco en segundo plano fallido {key}: {e}")
+
+    with _aemet_lock:
+        if key in _aemet_inflight:
+            return
+    _aemet_refresh_pool.submit(run)
+
+def _get_aemet_ccaa_hoy(ccaa: str, api_key: str) -> Tuple[dict, str]:
+    """
+    Predicción de hoy para 'ccaa' pasando por la caché.
+    Devuelve (datos, estado) con estado HIT | STALE | MISS | STALE-ERROR.
+    """
+    key = _aemet_cache_key(ccaa)
+    entry = _aemet_cache_get(key)
+    now = time.time()
+    if entry is not None and now < entry["expiresAt"]:
+        return entry["data"], "HIT"
+    if entry is not None and now - entry["fetchedAt"] < AEMET_CACHE_MAX_STALE_SEC:
+        # Nota: sin "CPU always allocated" el refresco avanza sobre todo en las siguientes peticiones
+        _aemet_refresh_in_background(key, ccaa, api_key)
+        return entry["data"], "STALE"
+    try:
+        return _aemet_fetch_once(key, ccaa, api_key)["data"], "MISS"
+    except Exception:
+        # AEMET caído o lento: última copia buena (de hoy o, si no hay, de ayer)
+        fallback = entry or _aemet_cache_get(_aemet_cache_key(ccaa, datetime.now(_MADRID) - timedelta(days=1)))
+        if fallback is not None:
+            return fallback["data"], "STALE-ERROR"
+        raise
+
+# Cache-Control de aemet_ccaa_hoy: el navegador guarda como mucho AEMET_HTTP_MAX_AGE y
+# el CDN lo que le quede a la entrada de la caché (sin pasar de medianoche: cambia el "hoy").
+# Las copias caducadas se sirven con s-maxage corto mientras se refrescan.
+AEMET_HTTP_MAX_AGE = int(os.getenv("AEMET_HTTP_MAX_AGE", "300"))
+AEMET_HTTP_STALE_S_MAXAGE = 60
+
+def _aemet_cache_control(ccaa: str, status: str) -> Tuple[int, int]:
+    """(max-age, s-maxage) para la respuesta de 'ccaa' recién servida con 'status'."""
+    if status in ("STALE", "STALE-ERROR"):
+        return 0, AEMET_HTTP_STALE_S_MAXAGE
+    entry = _aemet_mem.get(_aemet_cache_key(ccaa))
+    left = int(entry["expiresAt"] - time.time()) if entry else 0
+    now = datetime.now(_MADRID)
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    left = max(0, min(left, int((midnight - now).total_seconds())))
+    return min(left, AEMET_HTTP_MAX_AGE), left
+
+# ---------- AEMET: pre-calentado programado ----------
+# Códigos de CCAA de AEMET OpenData (se pueden cambiar con AEMET_CCAA_LIST="AND,ARN,...").
+AEMET_CCAA = [
+    c.strip().upper()
+    for c in os.getenv(
+        "AEMET_CCAA_LIST",
+        "AND,ARN,AST,BAL,COO,CAN,CLE,CLM,CAT,EXT,GAL,MAD,MUR,NAV,PVA,RIO,VAL",
+    ).split(",")
+    if c.strip()
+]
+AEMET_PREWARM_WORKERS = int(os.getenv("AEMET_PREWARM_WORKERS", "4"))
+AEMET_PREWARM_RETRIES = 3
+AEMET_PREWARM_BACKOFF_SEC = 2.0
+# Las copias pre-calentadas valen hasta la siguiente ejecución (cada 6 h) con margen.
+# La de las 00:05 llena la clave del día nuevo (la caché va por fecha de Madrid) antes
+# de que llegue el primer usuario.
+AEMET_PREWARM_TTL_SEC = int(os.getenv("AEMET_PREWARM_TTL_SEC", str(6 * 3600 + 1800)))
+# Timeout de aemet_prewarm. Un intento (dos saltos) tarda como mucho 2 x AEMET_HTTP["budget"]:
+# no se empieza uno que no acabaría antes del timeout (menos un margen para guardar la ejecución).
+AEMET_PREWARM_TIMEOUT_SEC = 300
+AEMET_PREWARM_MARGIN_SEC = 15
+
+def _prewarm_ccaa(ccaa: str, api_key: str, deadline: Optional[float] = None) -> Dict[str, Any]:
+    """Descarga y cachea una CCAA con reintentos (backoff exponencial con jitter) hasta 'deadline'."""
+    key = _aemet_cache_key(ccaa)
+    started = time.monotonic()
+    error = None
+    for attempt in range(1, AEMET_PREWARM_RETRIES + 1):
+        if deadline is not None and time.monotonic() + 2 * AEMET_HTTP["budget"] > deadline:
+            error = error or "Sin tiempo para pedirla antes del timeout del pre-calentado"
+            attempt -= 1
+            break
+        try:
+            _aemet_fetch_once(key, ccaa, api_key, ttl=AEMET_PREWARM_TTL_SEC)
+            error = None
+            break
+        except Exception as e:
+            error = str(e)
+            if attempt < AEMET_PREWARM_RETRIES:
+                time.sleep(AEMET_PREWARM_BACKOFF_SEC * 2 ** (attempt - 1) * (0.5 + random.random()))
+    return {
+        "ccaa": ccaa,
+        "ok": error is None,
+        "attempts": attempt,
+        "ms": round((time.monotonic() - started) * 1000),
+        "error": error,
+    }
+
+def prewarm_aemet(ccaa_list: List[str], api_key: str) -> Dict[str, Any]:
+    """Pre-calienta la caché de todas las CCAA en paralelo y guarda el resultado en 'aemet_prewarm_runs'."""
+    started_at = _utc_now_iso()
+    started = time.monotonic()
+    deadline = started + AEMET_PREWARM_TIMEOUT_SEC - AEMET_PREWARM_MARGIN_SEC
+    with ThreadPoolExecutor(max_workers=max(1, AEMET_PREWARM_WORKERS), thread_name_prefix="aemet-prewarm") as pool:
+        results = list(pool.map(lambda c: _prewarm_ccaa(c, api_key, deadline), ccaa_list))
+    run = {
+        "startedAt": started_at,
+        "finishedAt": _utc_now_iso(),
+        "durationMs": round((time.monotonic() - started) * 1000),
+        "okCount": sum(1 for r in results if r["ok"]),
+        "failedCount": sum(1 for r in results if not r["ok"]),
+        "results": results,
+    }
+    _get_db().collection("aemet_prewarm_runs").document().set(run)
+    return run
+
+# ---------- AEMET: varias CCAA en una petición ----------
+# aemet_ccaa_hoy acepta una lista (?ccaa=MUR,AND,VAL, /aemet/ccaa/MUR,AND,VAL o '*' = todas
+# las de AEMET_CCAA). Las regiones se piden en paralelo a través de la caché con hilos
+# propios de cada petición (tantos como regiones, hasta AEMET_BATCH_WORKERS, por defecto
+# las conexiones que la Session de AEMET mantiene abiertas): una petición no espera en
+# cola detrás de otra. La respuesta tarda lo que la región más lenta y no la suma. Si una
+# región no llega en AEMET_BATCH_TIMEOUT_SEC se devuelve su error y la descarga sigue
+# llenando la caché.
+AEMET_BATCH_WORKERS = int(os.getenv("AEMET_BATCH_WORKERS", str(AEMET_HTTP["pool"])))
+AEMET_BATCH_TIMEOUT_SEC = float(os.getenv("AEMET_BATCH_TIMEOUT_SEC", "25"))
+_CCAA_CODE = re.compile(r"^[A-Z]{2,3}$")
+
+def _parse_ccaa_list(value: str) -> List[str]:
+    """'MUR, and,MUR' -> ['MUR', 'AND']; '*' -> AEMET_CCAA."""
+    if value.strip() == "*":
+        return list(AEMET_CCAA)
+    codes: List[str] = []
+    for code in value.split(","):
+        code = code.strip().upper()
+        if code and code not in codes:
+            codes.append(code)
+    return codes
+
+def _get_aemet_ccaa_batch(codes: List[str], api_key: str) -> Dict[str, Dict[str, Any]]:
+    """
+    {CCAA: {"ok", "cache", "data"} | {"ok": False, "error"}} en el orden de 'codes'.
+    Un fallo (o timeout) en una región no afecta a las demás.
+    """
+    futures: Dict[str, Future] = {}
+    regions: Dict[str, Dict[str, Any]] = {}
+    valid = [code for code in codes if _CCAA_CODE.match(code)]
+    if valid:
+        pool = ThreadPoolExecutor(
+            max_workers=max(1, min(len(valid), AEMET_BATCH_WORKERS)), thread_name_prefix="aemet-batch"
+        )
+        for code in valid:
+            futures[code] = pool.submit(_get_aemet_ccaa_hoy, code, api_key)
+        pool.shutdown(wait=False)  # las que no lleguen a tiempo terminan solas (y llenan la caché)
+    deadline = time.monotonic() + AEMET_BATCH_TIMEOUT_SEC
+    for code in codes:
+        fut = futures.get(code)
+        if fut is None:
+            regions[code] = {"ok": False, "error": "Código de CCAA no válido"}
+            continue
+        try:
+            data, status = fut.result(timeout=max(0.0, deadline - time.monotonic()))
+            regions[code] = {"ok": True, "cache": status, "data": data}
+        except FutureTimeoutError:
+            regions[code] = {"ok": False, "error": f"Sin respuesta de AEMET en {AEMET_BATCH_TIMEOUT_SEC:g} s"}
+        except Exception as e:
+            regions[code] = {"ok": False, "error": str(e)}
+    return regions
+
+def _aemet_batch_cache_control(regions: Dict[str, Dict[str, Any]]) -> Optional[Tuple[int, int]]:
+    """La ventana más corta de todas las regiones; sin caché si alguna falló."""
+    if any(not r["ok"] for r in regions.values()):
+        return None
+    windows = [_aemet_cache_control(code, r["cache"]) for code, r in regions.items()]
+    return min(w[0] for w in windows), min(w[1] for w in windows)
+
 # ---------- Config de la API ----------
+# COOKIES, FORM_DATA y ENDPOINTS se construyen la primera vez que se usan (ver
+# _get_regfi_config al final de ENDPOINTS): las funciones AEMET comparten este módulo
+# y no los necesitan. Desde fuera siguen disponibles como main.ENDPOINTS, etc.
 URL = "https://servicio.mapa.gob.es/regfiweb/Exportaciones/ExportJsonProductos"
 
 HEADERS = {
@@ -127,40 +650,158 @@ HEADERS = {
 
 # Mueve las cookies a un secreto/var de entorno si puedes (JSON tipo {"_ga":"...","_gid":"..."}).
 # Si defines MAPA_COOKIES='{"_ga":"..."}' en Secret Manager/vars de Firebase:
-COOKIES = json.loads(os.getenv("MAPA_COOKIES", "{}")) or {
-    "_gid": "GA1.3.1295578295.1761156780",
-    "_dc_gtm_UA-121160996-1": "1",
-    "_dc_gtm_UA-121160996-2": "1",
-    "_ga_2V2T5QNMCX": "GS2.1.s1761156779$o1$g1$t1761156842$j60$l0$h0",
-    "_ga": "GA1.3.588007663.1761156780",
-    "_ga_39YRSEJH6H": "GS2.3.s1761156779$o1$g1$t1761156844$j58$l0$h0",
-}
+def _mapa_cookies() -> Dict[str, str]:
+    return json.loads(os.getenv("MAPA_COOKIES", "{}")) or {
+        "_gid": "GA1.3.1295578295.1761156780",
+        "_dc_gtm_UA-121160996-1": "1",
+        "_dc_gtm_UA-121160996-2": "1",
+        "_ga_2V2T5QNMCX": "GS2.1.s1761156779$o1$g1$t1761156842$j60$l0$h0",
+        "_ga": "GA1.3.588007663.1761156780",
+        "_ga_39YRSEJH6H": "GS2.3.s1761156779$o1$g1$t1761156844$j58$l0$h0",
+    }
 
-FORM_DATA = {
-    "dataDto[nombreComercial]": "",
-    "dataDto[titular]": "",
-    "dataDto[numRegistro]": "",
-    "dataDto[fabricante]": "",
-    "dataDto[idSustancia]": "-1",
-    "dataDto[idPlaga]": "-1",
-    "dataDto[idFuncion]": "-1",
-    "dataDto[idEstado]": "1",
-    "dataDto[idCultivo]": "-1",
-    "dataDto[idSistemaCultivo]": "-1",
-    "dataDto[idTipoUsuario]": "-1",
-    "dataDto[ancestrosCultivos]": "false",
-    "dataDto[ancestrosPlagas]": "false",
-    "dataDto[fecRenoDesde]": "",
-    "dataDto[fecRenoHasta]": "",
-    "dataDto[fecInscDesde]": "",
-    "dataDto[fecInscHasta]": "",
-    "dataDto[fecModiDesde]": "",
-    "dataDto[fecModiHasta]": "",
-    "dataDto[fecCaduDesde]": "",
-    "dataDto[fecCaduHasta]": "",
-    "dataDto[fecLimiDesde]": "",
-    "dataDto[fecLimiHasta]": "",
-}
+def _productos_form() -> Dict[str, str]:
+    return {
+        "dataDto[nombreComercial]": "",
+        "dataDto[titular]": "",
+        "dataDto[numRegistro]": "",
+        "dataDto[fabricante]": "",
+        "dataDto[idSustancia]": "-1",
+        "dataDto[idPlaga]": "-1",
+        "dataDto[idFuncion]": "-1",
+        "dataDto[idEstado]": "1",
+        "dataDto[idCultivo]": "-1",
+        "dataDto[idSistemaCultivo]": "-1",
+        "dataDto[idTipoUsuario]": "-1",
+        "dataDto[ancestrosCultivos]": "false",
+        "dataDto[ancestrosPlagas]": "false",
+        "dataDto[fecRenoDesde]": "",
+        "dataDto[fecRenoHasta]": "",
+        "dataDto[fecInscDesde]": "",
+        "dataDto[fecInscHasta]": "",
+        "dataDto[fecModiDesde]": "",
+        "dataDto[fecModiHasta]": "",
+        "dataDto[fecCaduDesde]": "",
+        "dataDto[fecCaduHasta]": "",
+        "dataDto[fecLimiDesde]": "",
+        "dataDto[fecLimiHasta]": "",
+    }
+
+# ---------- Ingesta incremental ----------
+# Con REGFI_INCREMENTAL=0 se reescriben todos los items en cada ejecución (modo "full").
+INCREMENTAL = os.getenv("REGFI_INCREMENTAL", "1") != "0"
+BATCH_SIZE = 450
+
+# ---------- Concurrencia de la ingesta ----------
+# Endpoints descargados/procesados a la vez y batches en vuelo por contenedor.
+# Con max_instances=5, el techo global es 5 * REGFI_MAX_INFLIGHT_COMMITS commits
+# simultáneos (cada uno de <=450 escrituras): bájalo si Firestore empieza a
+# devolver RESOURCE_EXHAUSTED/contención.
+ENDPOINT_WORKERS = max(1, int(os.getenv("REGFI_ENDPOINT_WORKERS", "4")))
+MAX_INFLIGHT_COMMITS = max(1, int(os.getenv("REGFI_MAX_INFLIGHT_COMMITS", "8")))
+
+# ---------- Descarga en streaming ----------
+# Con REGFI_STREAMING=0 (o "stream": False en el endpoint) se vuelve a r.json().
+STREAMING = os.getenv("REGFI_STREAMING", "1") != "0"
+STREAM_CHUNK_SIZE = 64 * 1024
+# Entradas {docId: huella} por documento de manifiesto (lejos del límite de 1 MiB).
+MANIFEST_SHARD_SIZE = 4000
+# Items cambiados cuya versión anterior se lee de golpe (get_all) para el historial
+HISTORY_READ_BATCH = 100
+
+# ---------- Métricas de la ingesta ----------
+# Tiempo por etapa (descarga, parseo, decodificación, huella, commits...), bytes,
+# items/s, RSS y percentiles de latencia de commit de cada invocación. El RSS es el
+# actual al cerrar la invocación y su diferencia con el del principio ('rssDeltaMb');
+# 'processPeakRssMb' es el pico de todo el proceso (ru_maxrss), no el de la invocación:
+# en un contenedor caliente puede venir de una invocación anterior.
+# Se guardan en el snapshot ('metrics', una entrada por invocación) y salen como
+# log estructurado (una línea JSON que Cloud Logging indexa por campo).
+try:
+    import resource
+except ImportError:  # Windows (desarrollo local): sin RSS
+    resource = None
+
+def _process_peak_rss_mb() -> Optional[float]:
+    """Pico de memoria residente del proceso desde que arrancó (ru_maxrss viene en KiB en Linux)."""
+    if resource is None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def _rss_mb() -> Optional[float]:
+    """Memoria residente actual del proceso (Linux: /proc/self/statm, en páginas)."""
+    try:
+        with open("/proc/self/statm") as fh:
+            pages = int(fh.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+
+def _percentiles_ms(values: List[float], points: Iterable[int] = (50, 95, 99)) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+    last = len(ordered) - 1
+    out = {f"p{p}": ordered[round(p / 100 * last)] for p in points}
+    out["max"] = ordered[-1]
+    return {k: round(v * 1000, 2) for k, v in out.items()}
+
+class _Metrics:
+    """
+    Acumulador de una invocación. Las etapas del hilo de ingesta suman tiempo en local
+    y lo vuelcan con add_time(); los commits llegan desde el pool (de ahí el lock).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._rss_start = _rss_mb()
+        self.stages: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+        self.commit_latencies: List[float] = []
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
+
+    def commit(self, seconds: float, writes: int) -> None:
+        with self._lock:
+            self.commit_latencies.append(seconds)
+            self.counters["commits"] = self.counters.get("commits", 0) + 1
+            self.counters["commitWrites"] = self.counters.get("commitWrites", 0) + writes
+
+    def summary(self) -> Dict[str, Any]:
+        wall = time.perf_counter() - self._started
+        rss = _rss_mb()
+        with self._lock:
+            items = self.counters.get("items", 0)
+            return {
+                "at": _utc_now_iso(),
+                "wallSec": round(wall, 3),
+                "stagesSec": {k: round(v, 3) for k, v in sorted(self.stages.items())},
+                "counters": dict(self.counters),
+                "itemsPerSec": round(items / wall, 1) if items and wall > 0 else None,
+                "commitLatencyMs": _percentiles_ms(self.commit_latencies),
+                "rssMb": rss,
+                "rssDeltaMb": round(rss - self._rss_start, 1) if rss is not None and self._rss_start is not None else None,
+                "processPeakRssMb": _process_peak_rss_mb(),
+            }
+
+def _log(message: str, severity: str = "INFO", **fields: Any) -> None:
+    """Log estructurado: una línea JSON con 'severity' y 'message' (Cloud Logging)."""
+    print(json.dumps({"severity": severity, "message": message, **fields}, ensure_ascii=False, default=str))
 
 # ---------- Utilidades ----------
 def _maybe_decode(value: Any) -> Any:
@@ -179,6 +820,121 @@ def _maybe_decode(value: Any) -> Any:
         return {k: _maybe_decode(v) for k, v in value.items()}
     return value
 
+# ---------- JSON anidado: decodificación por esquema ----------
+# Una ruta es la secuencia de claves hasta un string que lleva JSON dentro
+# ("*" = cualquier elemento de una lista). Se aprenden por endpoint, se guardan en
+# 'regfi_schemas/{endpoint}' y en la siguiente ejecución cada item se recorre una vez, en
+# sitio, decodificando solo los strings de esas rutas. Un string que puede ser JSON en otra
+# ruta hace que ese item se escanee entero (_scan_decode) y su ruta pase al esquema.
+_ANY = "*"
+# Principio posible de un texto JSON con '{' o '[' (tras blancos): deja fuera textos como
+# "[ver etiqueta] ..." sin llegar a json.loads. NaN/Infinity también los acepta json.loads.
+_JSON_START = re.compile(r'\s*(?:\{\s*["}]|\[\s*[\]\[{"\-0-9tfnNI])')
+# En un texto JSON, un string que empieza por '{', '[', un blanco o un escape: si no hay
+# ninguno, lo decodificado no lleva más JSON dentro y no hace falta recorrerlo.
+_NESTED_START = re.compile(r'"[\s\\{\[]')
+
+def _scan_decode(value: Any, path: Tuple[str, ...], found: set) -> Any:
+    """Como _maybe_decode, pero anota en 'found' la ruta de cada string decodificado."""
+    if isinstance(value, str):
+        s = value.strip()
+        if s and s[0] in "{[":
+            try:
+                decoded = json.loads(s)
+            except json.JSONDecodeError:
+                return value
+            found.add(path)
+            return _scan_decode(decoded, path, found)
+        return value
+    if isinstance(value, list):
+        sub = path + (_ANY,)
+        return [_scan_decode(v, sub, found) for v in value]
+    if isinstance(value, dict):
+        return {k: _scan_decode(v, path + (k,), found) for k, v in value.items()}
+    return value
+
+def _decode_known(item: Any, paths: set) -> bool:
+    """
+    Decodifica en sitio, sin recursión, los strings de 'paths' (y lo que lleven dentro).
+    Devuelve False en cuanto ve un string que puede ser JSON en otra ruta; el item queda
+    a medias, pero _scan_decode sobre él da lo mismo que sobre el original.
+    """
+    stack: List[Tuple[Any, Tuple[str, ...]]] = [(item, ())]
+    while stack:
+        node, path = stack.pop()
+        is_dict = type(node) is dict
+        for key, v in (node.items() if is_dict else enumerate(node)):
+            t = type(v)
+            if t is str:
+                # Comprobación barata: casi ningún string empieza por '{', '[' o un blanco
+                if not v or (v[0] not in "{[" and not v[0].isspace()) or not _JSON_START.match(v):
+                    continue
+                sub = path + (key if is_dict else _ANY,)
+                if sub not in paths:
+                    return False
+                try:
+                    node[key] = json.loads(v.strip())
+                except json.JSONDecodeError:
+                    continue
+                if _NESTED_START.search(v):
+                    stack.append((node[key], sub))
+            elif t is dict or t is list:
+                stack.append((v, path + (key if is_dict else _ANY,)))
+    return True
+
+class _NestedJsonDecoder:
+    """
+    Sustituto de _maybe_decode por item para un endpoint: decodifica las rutas del
+    esquema (_decode_known) y, si el item trae algo que puede ser JSON en otra ruta, lo
+    escanea entero (_scan_decode) y añade al esquema las rutas nuevas. Sin esquema previo
+    se aprende así con los primeros items que traen JSON. El resultado es siempre el
+    mismo que el de _maybe_decode.
+    """
+
+    def __init__(self, paths: Optional[Iterable[Tuple[str, ...]]] = None):
+        self.paths = set(paths or ())
+        self.learning = not self.paths
+        self.rescans = 0
+        self.changed = False
+
+    def decode(self, item: Any) -> Any:
+        if type(item) is not dict and type(item) is not list:
+            return _maybe_decode(item)
+        if _decode_known(item, self.paths):
+            return item
+        self.rescans += 1
+        found: set = set()
+        item = _scan_decode(item, (), found)
+        new = found - self.paths
+        if new:
+            self.paths |= new
+            self.changed = True
+        return item
+
+    def stats(self) -> Dict[str, Any]:
+        return {"paths": len(self.paths), "learned": self.learning, "rescans": self.rescans}
+
+# Esquemas por endpoint (reutilizados entre invocaciones del mismo contenedor)
+_schema_cache: Dict[str, set] = {}
+
+def _load_decoder(db, ep: dict) -> _NestedJsonDecoder:
+    name = ep.get("name")
+    paths = _schema_cache.get(name)
+    if paths is None:
+        snap = db.collection("regfi_schemas").document(name).get()
+        stored = (snap.to_dict() or {}).get("paths") if snap.exists else None
+        paths = {tuple(json.loads(p)) for p in stored or ()}
+    return _NestedJsonDecoder(paths)
+
+def _save_decoder(db, ep: dict, decoder: _NestedJsonDecoder) -> None:
+    name = ep.get("name")
+    _schema_cache[name] = set(decoder.paths)
+    if decoder.changed:
+        db.collection("regfi_schemas").document(name).set({
+            "paths": sorted(json.dumps(list(p), ensure_ascii=False) for p in decoder.paths),
+            "updatedAt": _utc_now_iso(),
+        })
+
 def _utc_now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
@@ -197,187 +953,1939 @@ def _chunked(iterable: Iterable[Any], size: int) -> Iterable[List[Any]]:
     if chunk:
         yield chunk
 
+# Heurística: campo 'Contenido' u otros comunes donde viene la lista de items
+ITEMS_KEYS = ("Contenido", "contenido", "items", "data", "results")
+
+def _extract_items(payload: Any) -> List[Any]:
+    """Fan-out si payload es lista o si hay un campo 'Contenido' lista dentro de un dict."""
+    if isinstance(payload, list):
+        return payload
+    if isinstance(payload, dict):
+        for key in ITEMS_KEYS:
+            val = payload.get(key)
+            if isinstance(val, list):
+                return val
+    return []
+
+# Pool de commits compartido por todos los endpoints del contenedor
+_commit_pool: Optional[ThreadPoolExecutor] = None
+_commit_slots = threading.BoundedSemaphore(MAX_INFLIGHT_COMMITS)
+_commit_pool_lock = threading.Lock()
+
+def _get_commit_pool() -> ThreadPoolExecutor:
+    global _commit_pool
+    with _commit_pool_lock:
+        if _commit_pool is None:
+            _commit_pool = ThreadPoolExecutor(
+                max_workers=MAX_INFLIGHT_COMMITS, thread_name_prefix="regfi-commit"
+            )
+        return _commit_pool
+
+def _commit_batch(batch, writes: int, metrics: Optional[_Metrics] = None) -> None:
+    try:
+        t0 = time.perf_counter()
+        batch.commit()
+        if metrics is not None:
+            metrics.commit(time.perf_counter() - t0, writes)
+    finally:
+        _commit_slots.release()
+
+def _commit_writes(
+    db,
+    writes: Iterable[Tuple[Any, Dict[str, Any]]],
+    metrics: Optional[_Metrics] = None,
+) -> int:
+    """
+    Aplica (doc_ref, data) en batches de ~450 (margen < 500 operaciones por batch).
+    Cada campo de primer nivel de 'data' se sustituye entero y el resto del
+    documento se conserva (merge por lista de campos: con merge=True un mapa
+    como 'data' se fusionaría y dejaría claves viejas). Devuelve el nº de escrituras.
+
+    Los commits van al pool compartido: mientras uno viaja a Firestore se sigue
+    consumiendo 'writes' (descarga/decodificación) para preparar el siguiente.
+    Como mucho hay MAX_INFLIGHT_COMMITS batches en vuelo; si se llega al tope,
+    el productor espera (así la memoria no crece con el tamaño del export).
+    Con 'metrics' se registra la latencia de cada commit.
+    """
+    pool = _get_commit_pool()
+    pending: List[Future] = []
+    written = 0
+    try:
+        for chunk in _chunked(writes, BATCH_SIZE):
+            batch = db.batch()
+            for doc_ref, data in chunk:
+                batch.set(doc_ref, data, merge=list(data))  # idempotente
+            _commit_slots.acquire()
+            try:
+                pending.append(pool.submit(_commit_batch, batch, len(chunk), metrics))
+            except BaseException:
+                _commit_slots.release()
+                raise
+            written += len(chunk)
+            # Propaga pronto un commit fallido en vez de seguir escribiendo
+            done = [f for f in pending if f.done()]
+            for f in done:
+                pending.remove(f)
+                f.result()
+    finally:
+        errors = [f.exception() for f in pending]
+    for err in errors:
+        if err is not None:
+            raise err
+    return written
+
+# Conexiones a servicio.mapa.gob.es (ver HTTP_DEFAULTS): los exports tardan en generarse
+# Como mucho un reintento tras timeout de lectura: ~240 s en el peor caso (ver TASK_TIMEOUT_SEC)
+MAPA_HTTP: Dict[str, Any] = {
+    "pool": 4, "timeout": (10, 90), "retries": 4, "read_retries": 1, "backoff": 2.0, "budget": 240,
+}
+
 # ========= ENDPOINTS A PROCESAR =========
-ENDPOINTS = [
-    {
-        "name": "productos",
-        "collection": "regfi_productos",
-        "url": "https://servicio.mapa.gob.es/regfiweb/Exportaciones/ExportJsonProductos",
-        "method": "POST",
-        "headers": HEADERS,
-        "cookies": COOKIES,
-        "data": FORM_DATA,
-        "items_keys": ["Contenido", "items", "data", "results"],
-    },
-    {
-        "name": "formulados",
-        "collection": "regfi_formulados",
-        "url": "https://servicio.mapa.gob.es/regfiweb/Exportaciones/ExportJsonFormulados",
-        "method": "POST",
-        "headers": HEADERS,
-        "cookies": COOKIES,
-        "data": {
-            "dataDto[nombreFormulado]": "",
-            "dataDto[idFuncion]": "",
-            "dataDto[idAccion]": "",
-            "dataDto[idSustancia]": "",
-            "dataDto[idPreparado]": "",
+# "id_fields": campos candidatos (sin distinguir mayúsculas) con la clave natural
+# del item; el primero con valor es el ID del documento. Si no hay ninguno se
+# usa el sha1 del contenido como antes. En formulados y sustancias el último
+# candidato es el nombre: si dos items comparten clave (o coinciden tras el
+# saneado), el primero se queda la clave y los demás son "clave~2", "clave~3"...
+# en orden de aparición; nunca se pisan entre sí (cuentan en 'duplicateKeys').
+# "http": pool/timeout/reintentos del host (la primera Session creada por host manda).
+# "search_fields": grupo del índice de búsqueda -> claves (a cualquier profundidad) de las que sacar texto.
+def _build_endpoints(cookies: Dict[str, str], form_data: Dict[str, str]) -> List[dict]:
+    return [
+        {
+            "name": "productos",
+            "collection": "regfi_productos",
+            "url": "https://servicio.mapa.gob.es/regfiweb/Exportaciones/ExportJsonProductos",
+            "method": "POST",
+            "headers": HEADERS,
+            "cookies": cookies,
+            "http": MAPA_HTTP,
+            "data": form_data,
+            "items_keys": ["Contenido", "items", "data", "results"],
+            "id_fields": ["NumRegistro", "NumeroRegistro", "Registro"],
+            "search_fields": {
+                "nombre": ["NombreComercial"],
+                "titular": ["Titular", "Fabricante"],
+                "registro": ["NumRegistro", "NumeroRegistro"],
+                "sustancia": ["Sustancia", "Sustancias", "NombreSustancia", "Formulado"],
+                "cultivo": ["Cultivo", "Cultivos", "NombreCultivo"],
+                "plaga": ["Plaga", "Plagas", "Agente", "NombrePlaga"],
+            },
         },
-        "items_keys": ["Contenido", "items", "data", "results"],
-    },
-    {
-        "name": "sustancias",
-        "collection": "regfi_sustancias",
-        "url": "https://servicio.mapa.gob.es/regfiweb/Exportaciones/ExportJsonSustancias",
-        "method": "POST",
-        "headers": HEADERS,
-        "cookies": COOKIES,
-        "data": {
-            "dataDto[nombreSustancia]": "",
-            "dataDto[idFuncion]": "",
-            "dataDto[idAccion]": "",
-            "dataDto[idPreparado]": "",
+        {
+            "name": "formulados",
+            "collection": "regfi_formulados",
+            "url": "https://servicio.mapa.gob.es/regfiweb/Exportaciones/ExportJsonFormulados",
+            "method": "POST",
+            "headers": HEADERS,
+            "cookies": cookies,
+            "http": MAPA_HTTP,
+            "data": {
+                "dataDto[nombreFormulado]": "",
+                "dataDto[idFuncion]": "",
+                "dataDto[idAccion]": "",
+                "dataDto[idSustancia]": "",
+                "dataDto[idPreparado]": "",
+            },
+            "items_keys": ["Contenido", "items", "data", "results"],
+            "id_fields": ["IdFormulado", "CodigoFormulado", "Formulado"],
+            "search_fields": {
+                "nombre": ["NombreFormulado", "Formulado", "Nombre"],
+                "sustancia": ["Sustancia", "Sustancias", "NombreSustancia"],
+            },
         },
-        "items_keys": ["Contenido", "items", "data", "results"],
-    },
-    {
-        "name": "cultivos",
-        "collection": "regfi_cultivos",
-        "url": "https://servicio.mapa.gob.es/regfiweb/Exportaciones/ExportJsonCultivos",
-        "method": "POST",
-        "headers": HEADERS,
-        "cookies": COOKIES,
-        "data": {
-            "dataDto[nombreComun]": "",
-            "dataDto[nombreLatin]": "",
-            "dataDto[codigoEppo]": "",
-            "dataDto[idAgente]": "",
-            "dataDto[Agente]": "",
+        {
+            "name": "sustancias",
+            "collection": "regfi_sustancias",
+            "url": "https://servicio.mapa.gob.es/regfiweb/Exportaciones/ExportJsonSustancias",
+            "method": "POST",
+            "headers": HEADERS,
+            "cookies": cookies,
+            "http": MAPA_HTTP,
+            "data": {
+                "dataDto[nombreSustancia]": "",
+                "dataDto[idFuncion]": "",
+                "dataDto[idAccion]": "",
+                "dataDto[idPreparado]": "",
+            },
+            "items_keys": ["Contenido", "items", "data", "results"],
+            "id_fields": ["IdSustancia", "CodigoSustancia", "Sustancia"],
+            "search_fields": {
+                "nombre": ["NombreSustancia", "Sustancia", "Nombre"],
+            },
         },
-        "items_keys": ["Contenido", "items", "data", "results"],
-    },
-]
+        {
+            "name": "cultivos",
+            "collection": "regfi_cultivos",
+            "url": "https://servicio.mapa.gob.es/regfiweb/Exportaciones/ExportJsonCultivos",
+            "method": "POST",
+            "headers": HEADERS,
+            "cookies": cookies,
+            "http": MAPA_HTTP,
+            "data": {
+                "dataDto[nombreComun]": "",
+                "dataDto[nombreLatin]": "",
+                "dataDto[codigoEppo]": "",
+                "dataDto[idAgente]": "",
+                "dataDto[Agente]": "",
+            },
+            "items_keys": ["Contenido", "items", "data", "results"],
+            "id_fields": ["CodigoEppo", "Eppo", "IdCultivo"],
+            "search_fields": {
+                "nombre": ["NombreComun", "Cultivo", "Nombre"],
+                "latin": ["NombreLatin"],
+                "eppo": ["CodigoEppo"],
+            },
+        },
+    ]
+
+_regfi_config: Optional[Dict[str, Any]] = None
+_regfi_config_lock = threading.Lock()
+
+def _get_regfi_config() -> Dict[str, Any]:
+    """COOKIES, FORM_DATA y ENDPOINTS, construidos una vez por contenedor en el primer uso."""
+    global _regfi_config
+    with _regfi_config_lock:
+        if _regfi_config is None:
+            cookies = _mapa_cookies()
+            form_data = _productos_form()
+            _regfi_config = {
+                "COOKIES": cookies,
+                "FORM_DATA": form_data,
+                "ENDPOINTS": _build_endpoints(cookies, form_data),
+            }
+        return _regfi_config
+
+def _endpoints() -> List[dict]:
+    return _get_regfi_config()["ENDPOINTS"]
+
+def __getattr__(name: str) -> Any:
+    # PEP 562: main.ENDPOINTS, main.COOKIES y main.FORM_DATA siguen funcionando
+    if name in ("COOKIES", "FORM_DATA", "ENDPOINTS"):
+        return _get_regfi_config()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# ---------- Parseo JSON en streaming ----------
+_WS = re.compile(r"[ \t\n\r]*")
+_DECODER = json.JSONDecoder()
+
+class _JsonStream:
+    """
+    Lector incremental sobre trozos de texto JSON.
+    Solo sabe avanzar: decodifica un valor completo cada vez con raw_decode y
+    pide más texto cuando el valor no cabe todavía en el buffer.
+    """
+
+    def __init__(self, chunks: Iterator[str], offset: int = 0):
+        self._chunks = chunks
+        self._buf = ""
+        self._pos = 0
+        self._base = offset   # caracteres del texto anteriores al buffer
+        self._eof = False
+        self.positional = False   # True si los items salen de un array leído en streaming
+
+    def _fill(self, min_extra: int = 1) -> bool:
+        """Lee hasta 'min_extra' caracteres nuevos (o hasta el final). False si no había más."""
+        if self._pos:
+            self._buf = self._buf[self._pos:]
+            self._base += self._pos
+            self._pos = 0
+        start = len(self._buf)
+        parts = [self._buf]
+        read = 0
+        while read < min_extra:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._eof = True
+                break
+            parts.append(chunk)
+            read += len(chunk)
+        self._buf = "".join(parts)
+        return len(self._buf) > start
+
+    def tell(self) -> int:
+        """Posición (en caracteres desde el principio del texto) del siguiente carácter por leer."""
+        return self._base + self._pos
+
+    def peek(self) -> str:
+        """Siguiente carácter no blanco (sin consumirlo); '' al final del stream."""
+        while True:
+            self._pos = _WS.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, ch: str) -> None:
+        got = self.peek()
+        if got != ch:
+            raise ValueError(f"JSON inesperado: se esperaba {ch!r} y llegó {got!r}")
+        self._pos += 1
 
+    def value(self) -> Any:
+        """Decodifica el siguiente valor JSON completo."""
+        self.peek()
+        while True:
+            try:
+                obj, end = _DECODER.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # Valor cortado por el final del buffer: duplica lo leído y reintenta
+                if not self._fill(max(len(self._buf) - self._pos, STREAM_CHUNK_SIZE)):
+                    raise
+                continue
+            # Un número al final del buffer puede seguir en el siguiente trozo
+            if end == len(self._buf) and not self._eof and self._fill():
+                continue
+            self._pos = end
+            return obj
+
+    def array(self, resume: bool = False) -> Iterator[Any]:
+        """
+        Itera los elementos del array que empieza en la posición actual. Con 'resume'
+        la posición es justo detrás de un elemento (reanudación desde tell()).
+        """
+        self.positional = True
+        if not resume:
+            self.expect("[")
+            if self.peek() == "]":
+                self._pos += 1
+                return
+            yield self.value()
+        while True:
+            sep = self.peek()
+            self._pos += 1
+            if sep == "]":
+                return
+            if sep != ",":
+                raise ValueError(f"JSON inesperado en array: {sep!r}")
+            yield self.value()
+
+def _iter_stream_items(stream: _JsonStream, items_keys: Iterable[str]) -> Tuple[str, Iterator[Any]]:
+    """
+    Localiza la lista de items sin cargar el documento entero:
+      - '[...]'                      -> la propia lista
+      - '{..., "Contenido": [...]}'  -> la primera clave de 'items_keys' que sea lista
+      - '"..."' (JSON dentro de un string) -> no se puede trocear: decodifica entero
+    Devuelve (tipo del payload, iterador de items sin decodificar).
+    """
+    first = stream.peek()
+    if first == "[":
+        return "list", stream.array()
+    if first != "{":
+        payload = _maybe_decode(stream.value())
+        return type(payload).__name__, iter(_extract_items(payload))
 
-# ---------- Lógica principal ----------
-def fetch_and_parse(ep: dict) -> Any:
-    """Llama al endpoint (GET/POST) y normaliza JSON anidado."""
+    keys = set(items_keys)
+
+    def from_object() -> Iterator[Any]:
+        stream.expect("{")
+        while stream.peek() not in ("}", ""):
+            key = stream.value()
+            stream.expect(":")
+            if key in keys and stream.peek() == "[":
+                yield from stream.array()
+                return  # el resto del objeto no interesa
+            val = stream.value()
+            if key in keys and isinstance(val, str):
+                decoded = _maybe_decode(val)
+                if isinstance(decoded, list):
+                    yield from decoded
+                    return
+            if stream.peek() == ",":
+                stream.expect(",")
+
+    return "dict", from_object()
+
+def _open_export(ep: dict, stream: bool = False, conditional: Optional[Dict[str, str]] = None):
+    """
+    Abre la petición del export. Con 'conditional' (If-None-Match / If-Modified-Since)
+    un 304, o un 412 en métodos que no son GET, se devuelve tal cual: no ha cambiado.
+    """
     method = ep.get("method", "GET").upper()
     url = ep["url"]
-    headers = ep.get("headers") or {}
+    headers = {**(ep.get("headers") or {}), **(conditional or {})}
     cookies = ep.get("cookies") or {}
     data = ep.get("data")
+    session = _http_session(url, ep.get("http"))
+    timeout = _http_config(ep.get("http"))["timeout"]
 
     if method == "POST":
-        r = requests.post(url, headers=headers, cookies=cookies, data=data, timeout=60)
+        r = session.post(url, headers=headers, cookies=cookies, data=data, timeout=timeout, stream=stream)
     else:
-        r = requests.get(url, headers=headers, cookies=cookies, params=data, timeout=60)
-    r.raise_for_status()
-    return _maybe_decode(r.json())
+        r = session.get(url, headers=headers, cookies=cookies, params=data, timeout=timeout, stream=stream)
+    if conditional and r.status_code in (304, 412):
+        return r
+    try:
+        r.raise_for_status()
+    except requests.HTTPError:
+        r.close()  # con stream=True la conexión no vuelve al pool hasta cerrar la respuesta
+        raise
+    return r
 
-def save_snapshot_and_items(payload: Any, ep: dict) -> Dict[str, Any]:
-    db = _get_db()
+# ---------- Export en bruto: huella, petición condicional y archivo ----------
+# El cuerpo del export se descarga una vez, comprimido en memoria (zlib) y con su
+# sha256 calculado al vuelo. Si coincide con el del último snapshot del endpoint
+# (o el servidor responde 304) no se decodifica ni se escribe nada: el snapshot
+# queda como 'skipped' apuntando al anterior. Si cambia, se archiva por trozos en
+# 'regfi_raw/{snapshotId}/chunks' y se parsea desde ahí: las reanudaciones y
+# replay_raw() no vuelven a llamar a servicio.mapa.gob.es.
+# Mientras dura la descarga el cuerpo comprimido entero (~1/10 del JSON) está en memoria;
+# en Cloud Functions /tmp también es memoria, así que un fichero temporal no ahorraría nada.
+# De cada endpoint se guardan los REGFI_RAW_KEEP últimos archivos (solo se archiva cuando
+# el export cambia, así que el del último snapshot, también de los 'skipped', es el primero).
+RAW_ARCHIVE = os.getenv("REGFI_RAW_ARCHIVE", "1") != "0"
+RAW_KEEP = max(1, int(os.getenv("REGFI_RAW_KEEP", "4")))
+RAW_COLLECTION = "regfi_raw"
+RAW_CHUNK_BYTES = 900_000   # bytes comprimidos por documento (límite 1 MiB)
+RAW_COMPRESS_LEVEL = 6
+
+class _RawExport:
+    """Export descargado: trozos zlib de un único stream, huella y validadores HTTP."""
+
+    def __init__(
+        self,
+        chunks: List[bytes],
+        sha256: str,
+        size: int,
+        encoding: str = "utf-8-sig",
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        self.chunks = chunks
+        self.sha256 = sha256
+        self.size = size
+        self.encoding = encoding
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def meta(self) -> Dict[str, Any]:
+        return {
+            "sha256": self.sha256,
+            "bytes": self.size,
+            "compressedBytes": sum(len(c) for c in self.chunks),
+            "chunks": len(self.chunks),
+            "encoding": self.encoding,
+            "etag": self.etag,
+            "lastModified": self.last_modified,
+        }
+
+    def text(self) -> Iterator[str]:
+        """Texto del export en trozos de como mucho STREAM_CHUNK_SIZE bytes descomprimidos."""
+        unzip = zlib.decompressobj()
+        text_decoder = codecs.getincrementaldecoder(self.encoding)(errors="replace")
+        for chunk in self.chunks:
+            data = chunk
+            while data:
+                out = unzip.decompress(data, STREAM_CHUNK_SIZE)
+                data = unzip.unconsumed_tail
+                if out:
+                    yield text_decoder.decode(out)
+        yield text_decoder.decode(unzip.flush(), final=True)
+
+    def payload(self) -> Any:
+        return _maybe_decode(json.loads("".join(self.text())))
+
+    def items(
+        self,
+        ep: dict,
+        decoder: Optional[_NestedJsonDecoder] = None,
+        metrics: Optional[_Metrics] = None,
+        resume: Optional[Dict[str, Any]] = None,
+        skip: int = 0,
+    ) -> Tuple[str, Iterator[Any], Callable[[], Optional[Dict[str, Any]]]]:
+        """
+        Lee la lista de items del cuerpo comprimido en streaming, decodificando el JSON
+        anidado item a item con 'decoder' (esquema aprendido): solo hay en memoria el
+        trozo de texto en curso y los items que aún no se han escrito. Devuelve
+        (tipo del payload, items, tell): tell() da la posición tras el último item
+        entregado ({"chars", "type"}) para reanudar con 'resume' sin volver a parsear
+        ni decodificar lo anterior (None si los items no salen de un array en streaming:
+        entonces se reanuda con 'skip', saltando items parseados pero sin decodificar).
+        Con 'metrics' separa el tiempo de parseo (descompresión + JSON) del de decodificación.
+        """
+        keys = (*ITEMS_KEYS, *(ep.get("items_keys") or ()))
+        if resume:
+            offset = int(resume["chars"])
+            stream = _JsonStream(_skip_chars((t for t in self.text() if t), offset), offset)
+            payload_type, raw_items = resume.get("type") or "list", stream.array(resume=True)
+        else:
+            stream = _JsonStream(t for t in self.text() if t)
+            payload_type, raw_items = _iter_stream_items(stream, keys)
+            t0 = time.perf_counter()
+            for _ in range(skip):
+                if next(raw_items, _END) is _END:
+                    break
+            if metrics is not None and skip:
+                metrics.add_time("resumeSkip", time.perf_counter() - t0)
+
+        def tell() -> Optional[Dict[str, Any]]:
+            return {"chars": stream.tell(), "type": payload_type} if stream.positional else None
+
+        decode = decoder.decode if decoder is not None else _maybe_decode
+        if metrics is None:
+            return payload_type, (decode(item) for item in raw_items), tell
+
+        def timed() -> Iterator[Any]:
+            parse = decoding = 0.0
+            clock = time.perf_counter
+            try:
+                while True:
+                    t0 = clock()
+                    item = next(raw_items, _END)
+                    t1 = clock()
+                    parse += t1 - t0
+                    if item is _END:
+                        return
+                    item = decode(item)
+                    decoding += clock() - t1
+                    yield item
+            finally:
+                metrics.add_time("parse", parse)
+                metrics.add_time("decode", decoding)
+
+        return payload_type, timed(), tell
+
+def _skip_chars(chunks: Iterable[str], n: int) -> Iterator[str]:
+    """Descarta los 'n' primeros caracteres de un texto en trozos."""
+    for chunk in chunks:
+        if n >= len(chunk):
+            n -= len(chunk)
+            continue
+        yield chunk[n:] if n else chunk
+        n = 0
+
+def fetch_export(ep: dict, previous: Optional[Dict[str, Any]] = None) -> Optional[_RawExport]:
     """
-    Guarda:
-      - Un snapshot en 'regfi_snapshots' (solo metadatos).
-      - Cada elemento en 'regfi_productos' con ID determinista y lastSeenAt.
-    Evita documentos gigantes (límite 1 MiB): no mete el payload entero en un único doc.
+    Descarga el cuerpo del export comprimiéndolo y calculando su sha256 al vuelo.
+    Con 'previous' (etag/lastModified del último snapshot) la petición es condicional
+    (en GET siempre; en POST solo si ep['conditional']). None = no ha cambiado (304).
     """
-    now = _utc_now_iso()
+    conditional: Dict[str, str] = {}
+    if previous and (ep.get("method", "GET").upper() == "GET" or ep.get("conditional")):
+        if previous.get("etag"):
+            conditional["If-None-Match"] = previous["etag"]
+        if previous.get("lastModified"):
+            conditional["If-Modified-Since"] = previous["lastModified"]
+    r = _open_export(ep, stream=True, conditional=conditional)
+    try:
+        if r.status_code in (304, 412):
+            return None
+        digest = hashlib.sha256()
+        zipper = zlib.compressobj(RAW_COMPRESS_LEVEL)
+        chunks: List[bytes] = []
+        buf = bytearray()
+        size = 0
+        for b in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            if not b:
+                continue
+            size += len(b)
+            digest.update(b)
+            buf += zipper.compress(b)
+            while len(buf) >= RAW_CHUNK_BYTES:
+                chunks.append(bytes(buf[:RAW_CHUNK_BYTES]))
+                del buf[:RAW_CHUNK_BYTES]
+        buf += zipper.flush()
+        for i in range(0, len(buf), RAW_CHUNK_BYTES):
+            chunks.append(bytes(buf[i:i + RAW_CHUNK_BYTES]))
+        return _RawExport(
+            chunks,
+            digest.hexdigest(),
+            size,
+            encoding=r.encoding or "utf-8-sig",
+            etag=r.headers.get("ETag"),
+            last_modified=r.headers.get("Last-Modified"),
+        )
+    finally:
+        r.close()
+
+def _save_raw(db, snapshot_id: str, ep: dict, raw: _RawExport) -> None:
+    """Archiva el export; el documento raíz se escribe al final y marca el archivo como completo."""
+    raw_ref = db.collection(RAW_COLLECTION).document(snapshot_id)
+    for i, chunk in enumerate(raw.chunks):
+        # Uno por escritura: un batch de trozos de ~1 MiB superaría el límite de la petición
+        raw_ref.collection("chunks").document(f"{i:05d}").set({"data": chunk})
+    raw_ref.set({
+        "endpoint": ep.get("name"),
+        "source": ep["url"],
+        "createdAt": _utc_now_iso(),
+        **raw.meta(),
+    })
+
+def _prune_raw(db, ep: dict) -> int:
+    """Borra los archivos del endpoint que no están entre los RAW_KEEP más recientes."""
+    query = (
+        db.collection(RAW_COLLECTION)
+        .where("endpoint", "==", ep.get("name"))
+        .order_by("createdAt", direction="DESCENDING")
+    )
+    deleted = 0
+    for i, doc in enumerate(query.stream()):
+        if i < RAW_KEEP:
+            continue
+        # Primero la raíz: sin ella load_raw_export ya no da el archivo por bueno
+        doc.reference.delete()
+        for j in range((doc.to_dict() or {}).get("chunks") or 0):
+            doc.reference.collection("chunks").document(f"{j:05d}").delete()
+        deleted += 1
+    return deleted
+
+def load_raw_export(db, snapshot_id: str) -> Optional[_RawExport]:
+    """Lee un export archivado (o None si no existe o quedó a medias)."""
+    raw_ref = db.collection(RAW_COLLECTION).document(snapshot_id)
+    meta = raw_ref.get().to_dict()
+    if not meta:
+        return None
+    docs = sorted(raw_ref.collection("chunks").stream(), key=lambda d: d.id)
+    chunks = [bytes((d.to_dict() or {}).get("data") or b"") for d in docs]
+    if len(chunks) != meta.get("chunks"):
+        return None
+    return _RawExport(
+        chunks,
+        meta["sha256"],
+        meta.get("bytes", 0),
+        encoding=meta.get("encoding") or "utf-8-sig",
+        etag=meta.get("etag"),
+        last_modified=meta.get("lastModified"),
+    )
+
+# Separador de las variantes de una clave duplicada ("clave~2"); no puede salir de _natural_key
+DUP_SEP = "~"
+
+def _natural_key(item: Any, ep: dict) -> Optional[str]:
+    """
+    Clave natural del item según ep['id_fields'], saneada para usarla como ID de documento
+    ('/', blancos y '~' -> '_'). El saneado puede hacer que dos claves distintas coincidan
+    ("A/B" y "A_B"): se tratan como una clave duplicada (ver _ingest_snapshot).
+    """
+    if not isinstance(item, dict):
+        return None
+    lowered = {str(k).lower(): v for k, v in item.items()}
+    for field in ep.get("id_fields") or ():
+        val = lowered.get(field.lower())
+        if val is None or isinstance(val, (dict, list)):
+            continue
+        key = re.sub(r"[/\s~]+", "_", str(val).strip())
+        if not key:
+            continue
+        if key in (".", "..") or (key.startswith("__") and key.endswith("__")):
+            key = f"k_{key}"
+        return key
+    return None
 
-    # Crea snapshot base
+def _fingerprint(item: Any) -> str:
+    """Huella barata del contenido: blake2b-128 del JSON compacto (sin ordenar claves)."""
+    blob = json.dumps(item, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.blake2b(blob.encode("utf-8"), digest_size=16).hexdigest()
+
+def _item_key(item: Any, ep: dict) -> Tuple[str, str]:
+    """
+    Devuelve (docId, huella) de un item. El ID es estable (clave natural) y la
+    huella decide si el item ha cambiado respecto al snapshot anterior.
+    """
+    fingerprint = _fingerprint(item)
+    doc_id = _natural_key(item, ep)
+    if doc_id is None:
+        doc_id = _hash_doc_id(item)
+    return doc_id, fingerprint
+
+def _history_doc(old: Dict[str, Any], new_item: Any, now: str, snapshot_id: str) -> Dict[str, Any]:
+    """
+    Versión anterior compacta: solo los campos de primer nivel de 'data' que
+    cambian, con su valor antiguo (None = el campo no existía).
+    """
+    old_data = old.get("data")
+    if isinstance(old_data, dict) and isinstance(new_item, dict):
+        previous = {
+            k: old_data.get(k)
+            for k in old_data.keys() | new_item.keys()
+            if old_data.get(k) != new_item.get(k)
+        }
+    else:
+        previous = {"data": old_data}
+    return {
+        "fingerprint": old.get("fingerprint"),
+        "snapshotId": old.get("snapshotId"),
+        "validFrom": old.get("lastChangedAt") or old.get("lastSeenAt"),
+        "replacedAt": now,
+        "replacedBySnapshotId": snapshot_id,
+        "previous": previous,
+    }
+
+def _last_snapshot(db, ep: dict):
+    """
+    Último snapshot finalizado del endpoint (o None). Puede ser uno 'skipped', sin
+    manifiesto propio: el snapshot con manifiesto es 'sameAsSnapshotId' (ver _manifest_snapshot).
+    """
+    query = (
+        db.collection("regfi_snapshots")
+        .where("endpoint", "==", ep.get("name"))
+        .order_by("createdAt", direction="DESCENDING")
+        .limit(10)
+    )
+    for doc in query.stream():
+        data = doc.to_dict() or {}
+        if data.get("finalizedAt") and (data.get("manifestShards") is not None or data.get("sameAsSnapshotId")):
+            return doc
+    return None
+
+def _manifest_snapshot(db, doc):
+    same_as = (doc.to_dict() or {}).get("sameAsSnapshotId")
+    return db.collection("regfi_snapshots").document(same_as).get() if same_as else doc
+
+def _load_manifest(snap_ref) -> Dict[str, str]:
+    """Lee el manifiesto {docId: huella} guardado en la subcolección 'manifest'."""
+    manifest: Dict[str, str] = {}
+    for doc in snap_ref.collection("manifest").stream():
+        manifest.update((doc.to_dict() or {}).get("items") or {})
+    return manifest
+
+def _touched_writes(snap_ref, touched: List[str], prefix: str = "r") -> Iterable[Tuple[Any, Dict[str, Any]]]:
+    for i, ids in enumerate(_chunked(touched, MANIFEST_SHARD_SIZE)):
+        yield snap_ref.collection("touched").document(f"{prefix}{i:04d}"), {"ids": ids}
+
+def _load_touched(snap_ref) -> List[str]:
+    ids: List[str] = []
+    for doc in sorted(snap_ref.collection("touched").stream(), key=lambda d: d.id):
+        ids.extend((doc.to_dict() or {}).get("ids") or ())
+    return ids
+
+def _plan_snapshot(db, ep: dict, incremental: Optional[bool] = None, run_id: Optional[str] = None):
+    """
+    Crea el snapshot (sin 'finalizedAt') con el checkpoint a cero y fija el snapshot
+    anterior contra el que se hará el diff, para que todas las reanudaciones usen el mismo.
+    """
+    if incremental is None:
+        incremental = INCREMENTAL
+    last = _last_snapshot(db, ep)
+    prev = _manifest_snapshot(db, last) if last is not None else None
+    last_data = (last.to_dict() or {}) if last is not None else {}
+    previous_raw = None
+    if last_data.get("raw"):
+        previous_raw = {
+            "sha256": last_data["raw"].get("sha256"),
+            "etag": last_data["raw"].get("etag"),
+            "lastModified": last_data["raw"].get("lastModified"),
+            "archiveId": last_data.get("rawSnapshotId"),
+        }
     snap_ref = db.collection("regfi_snapshots").document()
-    snapshot_doc = {
-        "createdAt": now,
+    snap_ref.set({
+        "createdAt": _utc_now_iso(),
         "source": ep["url"],
         "endpoint": ep.get("name"),
-        "type": type(payload).__name__,
-        "itemsCount": 0,
+        "collection": ep.get("collection"),
+        "mode": "incremental" if incremental else "full",
+        "runId": run_id,
+        "previousSnapshotId": prev.id if prev is not None else None,
+        "previousRaw": previous_raw,
+        "cursor": 0,
+        "segments": 0,
+        "writesCount": 0,
+        "counts": {"items": 0, "added": 0, "changed": 0, "unchanged": 0, "duplicateKeys": 0},
+    })
+    return snap_ref
+
+def _snapshot_result(snap_id: str, state: Dict[str, Any]) -> Dict[str, Any]:
+    keys = (
+        "itemsCount", "addedCount", "changedCount", "unchangedCount", "removedCount",
+        "duplicateKeysCount", "writesCount", "previousSnapshotId", "manifestShards", "touchedShards",
+        "skipped", "sameAsSnapshotId", "rawSnapshotId",
+    )
+    return {
+        "snapshotId": snap_id,
+        "createdAt": state.get("createdAt"),
+        "endpoint": state.get("endpoint"),
+        "collection": state.get("collection"),
+        **{k: state.get(k) for k in keys},
     }
 
-    # Fan-out si payload es lista o si hay un campo 'Contenido' lista dentro de un dict
-    items: List[Any] = []
-    if isinstance(payload, list):
-        items = payload
-    elif isinstance(payload, dict):
-        # Heurística: intenta campo 'Contenido' u otros comunes
-        for key in ("Contenido", "contenido", "items", "data", "results"):
-            val = payload.get(key)
-            if isinstance(val, list):
-                items = val
+def _ingest_snapshot(
+    db,
+    ep: dict,
+    snap_ref,
+    items: Iterable[Any],
+    payload_type: str = "list",
+    deadline: Optional[float] = None,
+    metrics: Optional[_Metrics] = None,
+    resumed: bool = False,
+    tell: Optional[Callable[[], Optional[Dict[str, Any]]]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Escribe 'items' en el snapshot 'snap_ref' desde su último checkpoint.
+
+    Los items se procesan por segmentos de hasta MANIFEST_SHARD_SIZE. Al cerrar cada segmento
+    (todas sus escrituras confirmadas) se guarda en un único batch el shard de manifiesto,
+    los IDs tocados, el cursor y la posición en el export (tell(), en 'resume'): si la
+    invocación muere, la siguiente sigue desde ahí (todas las escrituras son idempotentes).
+    'items' empieza en el primer item del export, salvo con 'resumed' (ya empieza en el cursor).
+    'deadline' (time.monotonic) se mira cada BATCH_SIZE items: si vence, el segmento se
+    cierra antes, se guarda el checkpoint y devuelve None (hay que volver a llamar); si no,
+    finaliza el snapshot (tombstones + 'finalizedAt') y devuelve el resumen.
+    """
+    state = snap_ref.get().to_dict() or {}
+    if state.get("finalizedAt"):
+        return _snapshot_result(snap_ref.id, state)
+
+    if metrics is None:
+        metrics = _Metrics()
+    clock = time.perf_counter
+    now = state["createdAt"]
+    incremental = state.get("mode") != "full"
+    prev_id = state.get("previousSnapshotId")
+    with metrics.stage("loadManifest"):
+        previous = _load_manifest(db.collection("regfi_snapshots").document(prev_id)) if prev_id else {}
+        manifest = _load_manifest(snap_ref)  # segmentos ya confirmados
+    cursor = state.get("cursor", 0)
+    segments = state.get("segments", 0)
+    written = state.get("writesCount", 0)
+    counts = dict(state.get("counts") or {})
+
+    # Variantes de claves duplicadas ya vistas: clave -> {huella: docId} (ver segment_writes)
+    variants: Dict[str, Dict[str, str]] = {}
+    for doc_id, fingerprint in manifest.items():
+        base, sep, n = doc_id.rpartition(DUP_SEP)
+        if sep and n.isdigit():
+            variants.setdefault(base, {})[fingerprint] = doc_id
+
+    col = db.collection(ep["collection"])
+
+    def item_doc(fingerprint: str, item: Any) -> Dict[str, Any]:
+        return {
+            "snapshotId": snap_ref.id,
+            "lastSeenAt": now,
+            "fingerprint": fingerprint,
+            "removedAt": None,
+            "data": item,
+        }
+
+    def with_history(changed: List[Tuple[str, str, Any]]) -> Iterable[Tuple[Any, Dict[str, Any]]]:
+        """Guarda la versión anterior en '{docId}/history' antes de sobrescribir."""
+        refs = [col.document(doc_id) for doc_id, _, _ in changed]
+        with metrics.stage("historyRead"):
+            olds = {snap.id: snap.to_dict() for snap in db.get_all(refs) if snap.exists}
+        for ref, (doc_id, fingerprint, item) in zip(refs, changed):
+            old = olds.get(doc_id)
+            # Si ya tiene la huella nueva es un reintento de este mismo segmento
+            if old and old.get("fingerprint") != fingerprint:
+                hist_id = f"{snap_ref.id}_{(old.get('fingerprint') or '')[:12]}"
+                yield ref.collection("history").document(hist_id), _history_doc(old, item, now, snap_ref.id)
+            yield ref, {**item_doc(fingerprint, item), "lastChangedAt": now}
+
+    def segment_writes(segment: Iterable[Any], seg_manifest: Dict[str, str], seg_touched: List[str]):
+        changed: List[Tuple[str, str, Any]] = []
+        hashing = 0.0
+        for item in segment:
+            counts["items"] += 1
+            t0 = clock()
+            doc_id, fingerprint = _item_key(item, ep)
+            hashing += clock() - t0
+            seen = manifest.get(doc_id) or seg_manifest.get(doc_id)
+            if seen == fingerprint:
+                continue  # duplicado exacto dentro del mismo export
+            if seen is not None:
+                # Misma clave natural con distinto contenido: la n-ésima variante distinta
+                # es "clave~n", estable mientras MAPA no cambie el orden de los duplicados
+                others = variants.setdefault(doc_id, {})
+                if fingerprint in others:
+                    continue
+                others[fingerprint] = doc_id = f"{doc_id}{DUP_SEP}{len(others) + 2}"
+                counts["duplicateKeys"] += 1
+            seg_manifest[doc_id] = fingerprint
+            old = previous.get(doc_id)
+            if old is None:
+                counts["added"] += 1
+                seg_touched.append(doc_id)
+                yield col.document(doc_id), {**item_doc(fingerprint, item), "firstSeenAt": now, "lastChangedAt": now}
+            elif old != fingerprint:
+                counts["changed"] += 1
+                seg_touched.append(doc_id)
+                changed.append((doc_id, fingerprint, item))
+                if len(changed) >= HISTORY_READ_BATCH:
+                    yield from with_history(changed)
+                    changed = []
+            else:
+                counts["unchanged"] += 1
+                if not incremental:
+                    yield col.document(doc_id), item_doc(fingerprint, item)
+        if changed:
+            yield from with_history(changed)
+        metrics.add_time("hash", hashing)
+
+    it = iter(items)
+    if not resumed:
+        for _ in range(cursor):  # ya confirmado en una invocación anterior
+            if next(it, _END) is _END:
                 break
 
-    upserted = 0
-    if items:
-        col = db.collection(ep["collection"])
-        # Batches de ~450 para margen < 500 operaciones por batch
-        for batch_items in _chunked(items, 450):
-            batch = db.batch()
-            for item in batch_items:
-                doc_id = _hash_doc_id(item)
-                doc_ref = col.document(doc_id)
-                batch.set(
-                    doc_ref,
-                    {
-                        "snapshotId": snap_ref.id,
-                        "lastSeenAt": now,
-                        "data": item,
-                    },
-                    merge=True,  # idempotente
-                )
-                upserted += 1
+    exhausted = False
+    out_of_time = False
+    while not exhausted and not out_of_time:
+        taken = 0
+
+        def segment() -> Iterator[Any]:
+            """Hasta MANIFEST_SHARD_SIZE items; corta antes si vence 'deadline' (mirado por batch)."""
+            nonlocal taken, exhausted, out_of_time
+            for item in it:
+                yield item
+                taken += 1
+                if taken >= MANIFEST_SHARD_SIZE:
+                    return
+                if deadline is not None and taken % BATCH_SIZE == 0 and time.monotonic() > deadline:
+                    out_of_time = True
+                    return
+            exhausted = True
+
+        seg_manifest: Dict[str, str] = {}
+        seg_touched: List[str] = []
+        written += _commit_writes(db, segment_writes(segment(), seg_manifest, seg_touched), metrics)
+        if not taken:
+            break
+        metrics.count("items", taken)
+        manifest.update(seg_manifest)
+        cursor += taken
+
+        # Checkpoint atómico del segmento
+        batch = db.batch()
+        batch.set(snap_ref.collection("manifest").document(f"{segments:04d}"), {"items": seg_manifest})
+        if seg_touched:
+            batch.set(snap_ref.collection("touched").document(f"s{segments:04d}"), {"ids": seg_touched})
+        segments += 1
+        checkpoint = {
+            "cursor": cursor,
+            "resume": tell() if tell is not None and not exhausted else None,
+            "segments": segments,
+            "writesCount": written,
+            "counts": counts,
+            "checkpointAt": _utc_now_iso(),
+        }
+        batch.set(snap_ref, checkpoint, merge=list(checkpoint))
+        with metrics.stage("checkpoint"):
             batch.commit()
+        if deadline is not None and time.monotonic() > deadline and not exhausted:
+            return None
 
-    # Actualiza snapshot con conteo
-    snap_ref.set(
-        {"itemsCount": upserted, "finalizedAt": now},
-        merge=True
-    )
+    # Tombstones: estaban en el snapshot anterior y ya no vienen
+    removed = sorted(previous.keys() - manifest.keys())
+    if not prev_id:
+        # Primer snapshot con manifiesto del endpoint: lo que ya haya en la colección y no
+        # haya venido (p. ej. los docs con ID sha1 de antes de las claves naturales, sin
+        # 'removedAt') se marca como borrado una vez; desde aquí basta el diff de manifiestos.
+        with metrics.stage("legacySweep"):
+            removed = sorted(
+                snap.id for snap in col.select(["removedAt"]).stream()
+                if snap.id not in manifest and not (snap.to_dict() or {}).get("removedAt")
+            )
+    written += _commit_writes(db, (
+        (col.document(doc_id), {"snapshotId": snap_ref.id, "removedAt": now}) for doc_id in removed
+    ), metrics)
+    _commit_writes(db, _touched_writes(snap_ref, removed))
+
+    # Cierra el snapshot con los conteos
+    touched = len(removed) + counts["added"] + counts["changed"]
+    summary = {
+        "type": payload_type,
+        "itemsCount": counts["items"],
+        "addedCount": counts["added"],
+        "changedCount": counts["changed"],
+        "unchangedCount": counts["unchanged"],
+        "removedCount": len(removed),
+        "duplicateKeysCount": counts["duplicateKeys"],
+        "writesCount": written,
+        "manifestShards": segments,
+        "touchedShards": -(-touched // MANIFEST_SHARD_SIZE),
+        "finalizedAt": _utc_now_iso(),
+    }
+    snap_ref.set(summary, merge=True)
+    return _snapshot_result(snap_ref.id, {**state, **summary})
+
+_END = object()
+
+def save_snapshot_and_items(payload: Any, ep: dict, incremental: Optional[bool] = None) -> Dict[str, Any]:
+    """Versión para payloads ya cargados en memoria (ver save_snapshot_items)."""
+    return save_snapshot_items(_extract_items(payload), ep, type(payload).__name__, incremental=incremental)
+
+def save_snapshot_items(
+    items: Iterable[Any],
+    ep: dict,
+    payload_type: str = "list",
+    incremental: Optional[bool] = None,
+) -> Dict[str, Any]:
+    """
+    Guarda:
+      - Un snapshot en 'regfi_snapshots' (solo metadatos, conteos y checkpoint).
+      - Un manifiesto {docId: huella} en 'regfi_snapshots/{id}/manifest', por shards,
+        y la lista de IDs añadidos/cambiados/borrados en 'regfi_snapshots/{id}/touched'.
+      - Los items nuevos o cambiados respecto al snapshot anterior del mismo endpoint,
+        con ID estable (clave natural). De los cambiados, la versión anterior va a
+        '{coleccion}/{docId}/history' (ordenable por 'replacedAt').
+        Los que ya no aparecen se marcan con 'removedAt' (tombstone), no se borran.
+    En modo incremental los items sin cambios no se reescriben, así que 'lastSeenAt'
+    es la fecha de la última escritura; el manifiesto es quien dice qué hay vivo.
+    'items' puede ser un generador: se consume una sola vez, batch a batch.
+    Evita documentos gigantes (límite 1 MiB): no mete el payload entero en un único doc.
+    """
+    db = _get_db()
+    snap_ref = _plan_snapshot(db, ep, incremental)
+    return _ingest_snapshot(db, ep, snap_ref, items, payload_type)
+
+def _snapshot_endpoint(
+    ep: dict,
+    incremental: Optional[bool] = None,
+    snap_ref=None,
+    deadline: Optional[float] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Descarga y escribe un endpoint. Con 'snap_ref' reanuda ese snapshot (ver _ingest_snapshot).
+    Las métricas de la invocación se añaden a 'metrics' del snapshot y salen por log
+    estructurado, también si falla.
+    """
+    db = _get_db()
+    if snap_ref is None:
+        snap_ref = _plan_snapshot(db, ep, incremental)
+    state = snap_ref.get().to_dict() or {}
+    metrics = _Metrics()
+    result = None
+    outcome = "error"
+    try:
+        result = _ingest_endpoint(db, ep, snap_ref, state, deadline, metrics)
+        if result is None:
+            outcome = "continued"
+        else:
+            outcome = "skipped" if result.get("skipped") else "done"
+    finally:
+        summary = {"outcome": outcome, **metrics.summary()}
+        _log(
+            "regfi_ingest_metrics",
+            severity="ERROR" if outcome == "error" else "INFO",
+            endpoint=ep.get("name"),
+            snapshotId=snap_ref.id,
+            **summary,
+        )
+        try:
+            snap_ref.set({"metrics": [*(state.get("metrics") or []), summary]}, merge=["metrics"])
+        except Exception as e:
+            print(f"[metrics][ERROR] {snap_ref.id}: {e}")
+    if result is None:
+        return None
+    return {**result, "metrics": summary}
+
+def _ingest_endpoint(
+    db,
+    ep: dict,
+    snap_ref,
+    state: Dict[str, Any],
+    deadline: Optional[float],
+    metrics: _Metrics,
+) -> Optional[Dict[str, Any]]:
+    """
+    Si el snapshot ya tiene el export archivado ('rawSnapshotId') se lee de ahí; si no, se
+    descarga y, en modo incremental, se corta aquí cuando el cuerpo es idéntico al anterior.
+    Archivar el export es en sí un checkpoint: si ya ha vencido 'deadline' devuelve None
+    y la siguiente invocación empieza leyendo el archivo, sin volver a descargar.
+    """
+    raw = None
+    if state.get("rawSnapshotId"):
+        with metrics.stage("archiveRead"):
+            raw = load_raw_export(db, state["rawSnapshotId"])
+        if raw is not None:
+            metrics.count("bytesArchiveRead", sum(len(c) for c in raw.chunks))
+    if raw is None:
+        previous_raw = state.get("previousRaw") if state.get("mode") != "full" else None
+        with metrics.stage("fetch"):
+            raw = fetch_export(ep, previous_raw)
+        if raw is not None:
+            metrics.count("bytesDownloaded", raw.size)
+            metrics.count("bytesCompressed", sum(len(c) for c in raw.chunks))
+        if previous_raw and (raw is None or raw.sha256 == previous_raw.get("sha256")):
+            return _skip_snapshot(db, snap_ref, state, raw)
+        if RAW_ARCHIVE:
+            with metrics.stage("archiveWrite"):
+                _save_raw(db, snap_ref.id, ep, raw)
+                metrics.count("archivesPruned", _prune_raw(db, ep))
+        info = {"raw": raw.meta(), "rawSnapshotId": snap_ref.id if RAW_ARCHIVE else None}
+        snap_ref.set(info, merge=list(info))
+        if RAW_ARCHIVE and deadline is not None and time.monotonic() > deadline:
+            return None
+    if not ep.get("stream", STREAMING):
+        with metrics.stage("parse"):
+            payload = raw.payload()
+        items = _extract_items(payload)
+        return _ingest_snapshot(db, ep, snap_ref, items, type(payload).__name__, deadline, metrics)
+    decoder = _load_decoder(db, ep)
+    cursor = state.get("cursor", 0)
+    resume = state.get("resume") if cursor else None
+    payload_type, items, tell = raw.items(ep, decoder, metrics, resume=resume, skip=0 if resume else cursor)
+    try:
+        result = _ingest_snapshot(
+            db, ep, snap_ref, items, payload_type, deadline, metrics, resumed=True, tell=tell,
+        )
+    finally:
+        items.close()
+    _save_decoder(db, ep, decoder)
+    if result is None:
+        return None
+    return {**result, "decoder": decoder.stats()}
+
+def _skip_snapshot(db, snap_ref, state: Dict[str, Any], raw: Optional[_RawExport]) -> Dict[str, Any]:
+    """Finaliza sin escribir items: el export es idéntico al del snapshot anterior."""
+    previous_raw = state.get("previousRaw") or {}
+    prev_id = state.get("previousSnapshotId")
+    prev = (db.collection("regfi_snapshots").document(prev_id).get().to_dict() or {}) if prev_id else {}
+    raw_meta = raw.meta() if raw is not None else {
+        "sha256": previous_raw.get("sha256"),
+        "etag": previous_raw.get("etag"),
+        "lastModified": previous_raw.get("lastModified"),
+    }
+    summary = {
+        "type": prev.get("type"),
+        "skipped": True,
+        "sameAsSnapshotId": prev_id,
+        "notModified": raw is None,
+        "raw": raw_meta,
+        "rawSnapshotId": previous_raw.get("archiveId"),
+        "itemsCount": prev.get("itemsCount", 0),
+        "addedCount": 0,
+        "changedCount": 0,
+        "unchangedCount": prev.get("itemsCount", 0),
+        "removedCount": 0,
+        "duplicateKeysCount": prev.get("duplicateKeysCount", 0),
+        "writesCount": 0,
+        "touchedShards": 0,
+        "finalizedAt": _utc_now_iso(),
+    }
+    snap_ref.set(summary, merge=True)
+    return _snapshot_result(snap_ref.id, {**state, **summary})
+
+def replay_raw(snapshot_id: str, incremental: Optional[bool] = None) -> Optional[Dict[str, Any]]:
+    """
+    Vuelve a ingerir el export archivado de 'snapshot_id' en un snapshot nuevo, sin
+    llamar a MAPA (p. ej. para reindexar o probar en local contra el emulador).
+    """
+    db = _get_db()
+    source = db.collection("regfi_snapshots").document(snapshot_id).get().to_dict() or {}
+    archive_id = source.get("rawSnapshotId")
+    if not archive_id:
+        raise ValueError(f"El snapshot {snapshot_id} no tiene export archivado")
+    if not db.collection(RAW_COLLECTION).document(archive_id).get().exists:
+        raise ValueError(f"El export de {snapshot_id} ya no está archivado (se guardan {RAW_KEEP} por endpoint)")
+    ep = _endpoint_by_name(source["endpoint"])
+    snap_ref = _plan_snapshot(db, ep, incremental)
+    info = {"raw": source.get("raw"), "rawSnapshotId": archive_id, "replayOf": snapshot_id}
+    snap_ref.set(info, merge=list(info))
+    return _snapshot_endpoint(ep, snap_ref=snap_ref)
+
+# ---------- Ingesta por tareas (reanudable) ----------
+# El programador solo planifica: crea 'regfi_runs/{runId}', un snapshot por endpoint y
+# encola una tarea por endpoint en 'regfi_ingest_task'. Cada tarea trabaja hasta
+# REGFI_TASK_BUDGET_SEC (mirado tras archivar el export y en cada batch), deja checkpoint y
+# se re-encola con el siguiente 'step'; si muere, Cloud Tasks la reintenta y sigue desde el
+# último checkpoint (leyendo el export archivado, así que no depende de que MAPA devuelva el
+# mismo orden). Cuando todas las partes están hechas se encola una única tarea
+# 'regfi_finalize_task' (task_id fijo por ejecución) con su propio timeout, que hace las
+# etapas finales (vistas; encola el índice); es idempotente y se reintenta hasta dejar la
+# ejecución 'done'.
+# Con REGFI_TASKS_INLINE=1 las tareas se ejecutan en el propio proceso (emulador/pruebas).
+INGEST_MODE = os.getenv("REGFI_INGEST_MODE", "tasks")
+TASK_QUEUE_FUNCTION = "regfi_ingest_task"
+FINALIZE_QUEUE_FUNCTION = "regfi_finalize_task"
+TASK_BUDGET_SEC = int(os.getenv("REGFI_TASK_BUDGET_SEC", "90"))
+# Límite duro de cada parte: la descarga del export no tiene checkpoint y puede llevarse el
+# presupuesto de reintentos de MAPA_HTTP entero antes de empezar con el presupuesto de arriba
+TASK_TIMEOUT_SEC = 540
+# Ingesta síncrona (run_snapshot): las cuatro descargas en paralelo y todo el proceso
+INGEST_TIMEOUT_SEC = 540
+FINALIZE_TIMEOUT_SEC = 1800
+TASKS_INLINE = os.getenv("REGFI_TASKS_INLINE") == "1"
+
+_inline_tasks: List[Tuple[str, Dict[str, Any]]] = []
+_inline_task_ids: set = set()
+_inline_draining = False
+
+def _endpoint_by_name(name: str) -> dict:
+    for ep in _endpoints():
+        if ep.get("name") == name:
+            return ep
+    raise ValueError(f"Endpoint desconocido: {name}")
+
+def _enqueue_task(function: str, task: Dict[str, Any], task_id: str) -> bool:
+    """Encola 'task' para 'function'. False si ya había una tarea con ese task_id."""
+    global _inline_draining
+    if TASKS_INLINE:
+        # Cola FIFO en el mismo proceso; sin recursión cuando una tarea encola otra
+        if task_id in _inline_task_ids:
+            return False
+        _inline_task_ids.add(task_id)
+        _inline_tasks.append((function, task))
+        if _inline_draining:
+            return True
+        _inline_draining = True
+        try:
+            while _inline_tasks:
+                name, pending = _inline_tasks.pop(0)
+                try:
+                    _TASK_HANDLERS[name](pending)
+                except Exception as e:
+                    # Como en Cloud Tasks (sin reintento): la tarea queda en 'error' y las demás siguen
+                    print(f"[tasks][inline][ERROR] {name} {json.dumps(pending)}: {e}")
+        finally:
+            _inline_draining = False
+        return True
+    from firebase_admin import functions as admin_functions
+    from firebase_admin.exceptions import AlreadyExistsError
+
+    _get_db()  # asegura initialize_app()
+    queue = admin_functions.task_queue(f"locations/{REGION}/functions/{function}")
+    try:
+        queue.enqueue(task, admin_functions.TaskOptions(task_id=task_id))
+    except AlreadyExistsError:
+        return False
+    return True
+
+def _enqueue_part(task: Dict[str, Any]) -> None:
+    # task_id deduplica re-encolados del mismo tramo
+    _enqueue_task(TASK_QUEUE_FUNCTION, task, f"{task['snapshotId']}-{task.get('step', 0)}")
+
+def plan_run(endpoints: List[dict], incremental: Optional[bool] = None) -> str:
+    """Crea la ejecución y encola una tarea por endpoint. Devuelve el runId."""
+    db = _get_db()
+    run_ref = db.collection("regfi_runs").document()
+    parts = {ep["name"]: _plan_snapshot(db, ep, incremental, run_ref.id).id for ep in endpoints}
+    run_ref.set({"createdAt": _utc_now_iso(), "status": "running", "parts": parts})
+    for name, snap_id in parts.items():
+        _enqueue_part({"runId": run_ref.id, "endpoint": name, "snapshotId": snap_id, "cursor": 0, "step": 0})
+    return run_ref.id
+
+def run_part(task: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Procesa (o continúa) una parte de la ejecución. None si se ha re-encolado."""
+    db = _get_db()
+    ep = _endpoint_by_name(task["endpoint"])
+    run_ref = db.collection("regfi_runs").document(task["runId"])
+    part_ref = run_ref.collection("parts").document(ep["name"])
+    snap_ref = db.collection("regfi_snapshots").document(task["snapshotId"])
+    deadline = time.monotonic() + TASK_BUDGET_SEC
+    step = task.get("step", 0)
+
+    part = part_ref.get().to_dict() or {}
+    if part.get("step", 0) > step:
+        # Reintento de un tramo que ya se re-encoló: solo asegura que la continuación existe
+        _enqueue_part({**task, "cursor": part.get("cursor", 0), "step": part["step"]})
+        return None
+    state = snap_ref.get().to_dict() or {}
+    if state.get("finalizedAt"):
+        result = _snapshot_result(snap_ref.id, state)  # tarea repetida: ya estaba hecha
+    else:
+        try:
+            result = _snapshot_endpoint(ep, snap_ref=snap_ref, deadline=deadline)
+        except Exception as e:
+            part_ref.set({"status": "error", "error": str(e), "updatedAt": _utc_now_iso()}, merge=True)
+            raise  # Cloud Tasks reintenta; se retoma desde el último checkpoint
+    if result is None:
+        cursor = (snap_ref.get().to_dict() or {}).get("cursor", 0)
+        # Primero el 'step' (así un reintento de esta tarea no repite el trabajo) y luego la tarea
+        part_ref.set({"status": "running", "cursor": cursor, "step": step + 1, "updatedAt": _utc_now_iso()}, merge=True)
+        _enqueue_part({**task, "cursor": cursor, "step": step + 1})
+        return None
+    part_ref.set({"status": "done", "result": result, "updatedAt": _utc_now_iso()}, merge=True)
+    _maybe_finalize_run(db, run_ref)
+    return result
+
+def _maybe_finalize_run(db, run_ref) -> bool:
+    """Si todas las partes están hechas, encola la finalización (una vez: task_id fijo)."""
+    run = run_ref.get().to_dict() or {}
+    if run.get("status") == "done":
+        return False
+    names = list(run.get("parts") or {})
+    parts = {doc.id: doc.to_dict() or {} for doc in run_ref.collection("parts").stream()}
+    if not names or any(parts.get(n, {}).get("status") != "done" for n in names):
+        return False
+    return _enqueue_task(FINALIZE_QUEUE_FUNCTION, {"runId": run_ref.id}, f"{run_ref.id}-finalize")
+
+def finalize_run(task: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Etapas finales de la ejecución (_post_ingest). Idempotente: si la invocación muere o
+    una etapa falla, la tarea se reintenta y se rehace entera; una ejecución 'done' no se toca.
+    """
+    db = _get_db()
+    run_ref = db.collection("regfi_runs").document(task["runId"])
+    run = run_ref.get().to_dict() or {}
+    if run.get("status") == "done":
+        return None
+    names = list(run.get("parts") or {})
+    parts = {doc.id: doc.to_dict() or {} for doc in run_ref.collection("parts").stream()}
+    totals = [parts[n]["result"] for n in names]
+    run_ref.set({
+        "status": "finalizing",
+        "finalizeStartedAt": _utc_now_iso(),
+        "finalizeAttempts": run.get("finalizeAttempts", 0) + 1,
+    }, merge=True)
+    post = _post_ingest(totals, [_endpoint_by_name(n) for n in names])
+    errors = {k: v for k, v in post.items() if k.endswith("Error")}
+    if errors:
+        run_ref.set({"status": "error", "finalizeErrors": errors}, merge=True)
+        raise RuntimeError(f"Finalización de {run_ref.id} incompleta: {errors}")
+    run_ref.set({
+        "status": "done",
+        "finalizedAt": _utc_now_iso(),
+        "totals": totals,
+        "post": post,
+    }, merge=True)
+    print(json.dumps({"ok": True, "runId": run_ref.id, "totals": totals}, ensure_ascii=False))
+    return post
+
+def run_snapshot(endpoints: List[dict], incremental: Optional[bool] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Procesa los endpoints en paralelo (hasta ENDPOINT_WORKERS a la vez).
+    Un fallo en un endpoint no afecta a los demás. Al terminar, si algo cambió,
+    actualiza las vistas cruzadas y encola el índice de búsqueda (_post_ingest).
+    Devuelve (totals, errors) en el orden de 'endpoints'.
+    """
+    totals: List[Dict[str, Any]] = []
+    errors: List[Dict[str, Any]] = []
+    workers = min(ENDPOINT_WORKERS, len(endpoints)) or 1
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="regfi-ep") as pool:
+        futures = [(ep, pool.submit(_snapshot_endpoint, ep, incremental)) for ep in endpoints]
+        for ep, fut in futures:
+            try:
+                totals.append(fut.result())
+            except Exception as e:
+                errors.append({"endpoint": ep.get("name"), "url": ep.get("url"), "error": str(e)})
+    post = _post_ingest(totals, endpoints)
+    if post.get("crossViews"):
+        print(f"[post_ingest] vistas cruzadas: {post['crossViews']}")
+    if post.get("searchIndex"):
+        print(f"[post_ingest] índice de búsqueda: tarea encolada (partes {post['searchIndex']['dirty']})")
+    return totals, errors
 
+# ---------- Índice de búsqueda ----------
+# Índice invertido compacto sobre los regfi_* (nombre, sustancia, cultivo, plaga...):
+# tokens sin acentos y en minúsculas, ordenados para buscar por prefijo con bisect.
+# Se guarda comprimido (zlib) y troceado en 'regfi_search/{version}/shards/{n}';
+# 'regfi_search/current' apunta a la versión vigente.
+# Se construye en su propia tarea (regfi_search_index_task), fuera de la ingesta. Cada
+# endpoint deja su parte del índice en 'regfi_search_parts/{endpoint}': la ingesta marca
+# 'dirtyAt' en las de los endpoints que cambiaron y la tarea solo vuelve a leer esas
+# colecciones; las demás partes se reutilizan tal cual. Una tarea que falle deja las
+# marcas y la siguiente las recoge.
+SEARCH_QUEUE_FUNCTION = "regfi_search_index_task"
+SEARCH_INDEX_TIMEOUT_SEC = 1800
+SEARCH_PARTS = "regfi_search_parts"
+SEARCH_SHARD_BYTES = 900_000
+SEARCH_INDEX_CHECK_SEC = 300   # cada cuánto mira una instancia si hay versión nueva
+SEARCH_MAX_LIMIT = 100
+# El índice cambia una vez por semana: el CDN puede guardar las búsquedas una hora
+SEARCH_HTTP_MAX_AGE = int(os.getenv("SEARCH_HTTP_MAX_AGE", "300"))
+SEARCH_HTTP_S_MAXAGE = int(os.getenv("SEARCH_HTTP_S_MAXAGE", "3600"))
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def _fold(text: str) -> str:
+    """Minúsculas y sin acentos/diacríticos ('Fungicida Cúprico' -> 'fungicida cuprico')."""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+def _tokens(text: str) -> List[str]:
+    return _TOKEN_RE.findall(_fold(text))
+
+def _find_values(value: Any, names: Iterable[str]) -> List[str]:
+    """Textos bajo las claves 'names' (sin distinguir mayúsculas) a cualquier profundidad."""
+    wanted = {n.lower() for n in names}
+    found: List[str] = []
+    stack: List[Tuple[Any, bool]] = [(value, False)]
+    while stack:
+        node, inside = stack.pop()
+        if isinstance(node, dict):
+            for k, v in reversed(list(node.items())):
+                stack.append((v, inside or str(k).lower() in wanted))
+        elif isinstance(node, list):
+            stack.extend((v, inside) for v in reversed(node))
+        elif inside and node is not None and not isinstance(node, bool):
+            found.append(str(node))
+    return found
+
+def _label(data: Any, names: Iterable[str], default: str) -> str:
+    """Nombre visible: primer campo de primer nivel de 'names' con texto (por prioridad)."""
+    if isinstance(data, dict):
+        lowered = {str(k).lower(): v for k, v in data.items()}
+        for name in names:
+            val = lowered.get(name.lower())
+            if isinstance(val, (str, int, float)) and str(val).strip():
+                return str(val).strip()
+    found = _find_values(data, names)
+    return found[0] if found else default
+
+def _search_part(db, ep: dict) -> Dict[str, Any]:
+    """Parte del índice de un endpoint: sus docs vivos y, por grupo, [token, ordinales]."""
+    docs: List[List[str]] = []
+    groups: Dict[str, Dict[str, set]] = {}
+    search_fields = ep.get("search_fields") or {}
+    for snap in db.collection(ep["collection"]).stream():
+        doc = snap.to_dict() or {}
+        if doc.get("removedAt") or "data" not in doc:
+            continue
+        data = doc["data"]
+        values = {group: _find_values(data, names) for group, names in search_fields.items()}
+        label = _label(data, search_fields.get("nombre") or (), snap.id)
+        ordinal = len(docs)
+        docs.append([ep["name"], snap.id, label])
+        for group, texts in values.items():
+            postings = groups.setdefault(group, {})
+            for text in texts:
+                for token in _tokens(text):
+                    postings.setdefault(token, set()).add(ordinal)
     return {
-        "snapshotId": snap_ref.id,
-        "itemsCount": upserted,
-        "createdAt": now,
-        "endpoint": ep.get("name"),
-        "collection": ep.get("collection"),
+        "docs": docs,
+        "groups": {
+            group: [[t, sorted(postings[t])] for t in sorted(postings)]
+            for group, postings in groups.items()
+        },
+    }
+
+def _save_search_part(db, name: str, part: Dict[str, Any], built_from: str) -> None:
+    """Guarda la parte (trozos nuevos, luego la raíz que apunta a ellos, luego borra los viejos)."""
+    part_ref = db.collection(SEARCH_PARTS).document(name)
+    previous = part_ref.get().to_dict() or {}
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    blob = zlib.compress(json.dumps(part, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+    shards = [blob[i:i + SEARCH_SHARD_BYTES] for i in range(0, len(blob), SEARCH_SHARD_BYTES)]
+    for i, shard in enumerate(shards):
+        # Uno por escritura, como en _save_raw: varios trozos en un batch pasarían del límite
+        part_ref.collection("shards").document(f"{version}-{i:03d}").set({"blob": shard})
+    # merge: no pisa un 'dirtyAt' marcado mientras se leía la colección
+    info = {"version": version, "shards": len(shards), "docsCount": len(part["docs"]), "builtFrom": built_from}
+    part_ref.set(info, merge=list(info))
+    for i in range(previous.get("shards") or 0):
+        part_ref.collection("shards").document(f"{previous['version']}-{i:03d}").delete()
+
+def _load_search_part(db, name: str) -> Optional[Dict[str, Any]]:
+    """La parte guardada si sigue al día (construida después del último 'dirtyAt'); si no, None."""
+    part_ref = db.collection(SEARCH_PARTS).document(name)
+    meta = part_ref.get().to_dict() or {}
+    if not meta.get("version") or meta.get("builtFrom", "") < (meta.get("dirtyAt") or ""):
+        return None
+    ids = [f"{meta['version']}-{i:03d}" for i in range(meta.get("shards") or 0)]
+    blobs = {
+        snap.id: bytes((snap.to_dict() or {}).get("blob") or b"")
+        for snap in db.get_all([part_ref.collection("shards").document(i) for i in ids])
+        if snap.exists
     }
+    if len(blobs) != len(ids):
+        return None
+    return json.loads(zlib.decompress(b"".join(blobs[i] for i in ids)).decode("utf-8"))
+
+def _mark_search_dirty(db, names: Iterable[str]) -> None:
+    """Las partes de 'names' se reconstruirán en la próxima tarea del índice."""
+    now = _utc_now_iso()
+    for name in names:
+        db.collection(SEARCH_PARTS).document(name).set({"dirtyAt": now}, merge=["dirtyAt"])
+
+def build_search_index(db, endpoints: List[dict], reuse: bool = False) -> Dict[str, Any]:
+    """
+    Construye el índice de los regfi_* vivos y publica una versión nueva. Con 'reuse' se
+    aprovechan las partes guardadas que siguen al día y solo se leen las colecciones marcadas.
+    """
+    docs: List[List[str]] = []
+    groups: Dict[str, Dict[str, List[int]]] = {}
+    rebuilt: List[str] = []
+    for ep in endpoints:
+        part = _load_search_part(db, ep["name"]) if reuse else None
+        if part is None:
+            built_from = _utc_now_iso()
+            part = _search_part(db, ep)
+            _save_search_part(db, ep["name"], part, built_from)
+            rebuilt.append(ep["name"])
+        base = len(docs)
+        docs.extend(part["docs"])
+        for group, entries in part["groups"].items():
+            postings = groups.setdefault(group, {})
+            for token, ordinals in entries:
+                # Las partes van en orden: los ordinales de cada token siguen ordenados
+                postings.setdefault(token, []).extend(o + base for o in ordinals)
+
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    index = {
+        "version": version,
+        "docs": docs,
+        "groups": {
+            group: [[t, postings[t]] for t in sorted(postings)]
+            for group, postings in groups.items()
+        },
+    }
+    blob = zlib.compress(json.dumps(index, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 9)
+    shards = [blob[i:i + SEARCH_SHARD_BYTES] for i in range(0, len(blob), SEARCH_SHARD_BYTES)]
+
+    root = db.collection("regfi_search")
+    version_ref = root.document(version)
+    _commit_writes(db, (
+        (version_ref.collection("shards").document(f"{i:03d}"), {"blob": shard})
+        for i, shard in enumerate(shards)
+    ))
+    current = root.document("current").get()
+    previous = (current.to_dict() or {}) if current.exists else {}
+    summary = {
+        "version": version,
+        "shards": len(shards),
+        "bytes": len(blob),
+        "docsCount": len(docs),
+        "tokensCount": sum(len(p) for p in groups.values()),
+        "rebuiltParts": rebuilt,
+        "builtAt": _utc_now_iso(),
+        "previousVersion": previous.get("version"),
+    }
+    version_ref.set(summary)
+    root.document("current").set(summary)
+
+    # La versión anterior se conserva (puede estar cargándose); la de antes, no
+    stale = previous.get("previousVersion")
+    if stale:
+        stale_ref = root.document(stale)
+        for shard in stale_ref.collection("shards").stream():
+            shard.reference.delete()
+        stale_ref.delete()
+    return summary
+
+def rebuild_search_index(task: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Tarea del índice de búsqueda: reconstruye las partes marcadas y publica."""
+    metrics = _Metrics()
+    with metrics.stage("searchIndex"):
+        summary = build_search_index(_get_db(), _endpoints(), reuse=True)
+    _log("regfi_search_index_metrics", version=summary["version"], rebuiltParts=summary["rebuiltParts"], **metrics.summary())
+    return summary
+
+class _SearchIndex:
+    """Índice cargado en memoria: por grupo, tokens ordenados y sus postings."""
+
+    def __init__(self, raw: Dict[str, Any]):
+        self.version = raw["version"]
+        self.docs = raw["docs"]
+        self.groups: Dict[str, Tuple[List[str], List[List[int]]]] = {}
+        for group, entries in raw["groups"].items():
+            self.groups[group] = ([e[0] for e in entries], [e[1] for e in entries])
+
+    def _prefix(self, group: str, prefix: str) -> set:
+        tokens, postings = self.groups.get(group, ([], []))
+        hits: set = set()
+        i = bisect.bisect_left(tokens, prefix)
+        while i < len(tokens) and tokens[i].startswith(prefix):
+            hits.update(postings[i])
+            i += 1
+        return hits
+
+    def match(self, text: str, groups: Iterable[str]) -> Optional[set]:
+        """Docs que casan con todos los tokens de 'text' (por prefijo) en alguno de 'groups'."""
+        result: Optional[set] = None
+        for token in _tokens(text):
+            hits: set = set()
+            for group in groups:
+                hits |= self._prefix(group, token)
+            result = hits if result is None else result & hits
+            if not result:
+                return set()
+        return result
+
+    def search(self, q: str, filters: Dict[str, str], tipos: Optional[set], limit: int) -> Tuple[int, List[Dict[str, str]]]:
+        candidates: Optional[set] = None
+        if q:
+            candidates = self.match(q, self.groups.keys())
+        for group, value in filters.items():
+            hits = self.match(value, [group])
+            if hits is None:
+                continue
+            candidates = hits if candidates is None else candidates & hits
+        if candidates is None:
+            return 0, []
+        if tipos:
+            candidates = {i for i in candidates if self.docs[i][0] in tipos}
+        first = (_tokens(q) or [""])[0]
+
+        def rank(i: int) -> Tuple[bool, str]:
+            label = _fold(self.docs[i][2])
+            return (not label.startswith(first), label)
+
+        ordered = sorted(candidates, key=rank)[:limit]
+        return len(candidates), [
+            {"tipo": self.docs[i][0], "id": self.docs[i][1], "nombre": self.docs[i][2]} for i in ordered
+        ]
+
+_search_index: Optional[_SearchIndex] = None
+_search_checked_at = 0.0
+_search_lock = threading.Lock()
+
+def _get_search_index() -> Optional[_SearchIndex]:
+    """Carga el índice una vez por instancia y lo recarga si se ha publicado otra versión."""
+    global _search_index, _search_checked_at
+    with _search_lock:
+        if _search_index is not None and time.time() - _search_checked_at < SEARCH_INDEX_CHECK_SEC:
+            return _search_index
+        root = _get_db().collection("regfi_search")
+        current = root.document("current").get()
+        _search_checked_at = time.time()
+        if not current.exists:
+            return _search_index
+        version = (current.to_dict() or {}).get("version")
+        if _search_index is None or _search_index.version != version:
+            shards = sorted(root.document(version).collection("shards").stream(), key=lambda d: d.id)
+            blob = b"".join(bytes((d.to_dict() or {})["blob"]) for d in shards)
+            _search_index = _SearchIndex(json.loads(zlib.decompress(blob)))
+        return _search_index
+
+# ---------- Vistas cruzadas cultivo / sustancia -> productos ----------
+# Documentos desnormalizados para responder con una sola lectura:
+#   regfi_view_cultivos/{cultivo}:    productos autorizados en el cultivo, con sus plagas y sustancias
+#   regfi_view_sustancias/{sustancia}: productos que llevan la sustancia (índice inverso) y sus cultivos
+# Se calculan desde 'regfi_productos' (el export que relaciona las tres cosas) y solo se
+# recalculan las vistas de los productos tocados en el snapshot. Cada producto guarda en
+# 'viewRefs' las vistas en las que aparece para poder sacarlo de ellas después.
+# Una vista es un documento raíz (nombre, 'nombres', 'productosCount', 'pages') y sus
+# productos van en 'pages/{n}' (orden por ID, ~VIEW_PAGE_BYTES por página, con 'porPlaga'
+# de esa página en las de cultivo): un cultivo con muchos productos no pasa de 1 MiB.
+# 'regfi_views_state/{VIEW_SOURCE}' guarda el último snapshot aplicado: si una ejecución
+# falla (o no llega a hacer las vistas), la siguiente aplica también los que quedaron.
+VIEW_SOURCE = "productos"
+VIEW_PAGE_BYTES = 500_000
+VIEW_STATE = "regfi_views_state"
+VIEW_FIELDS = {
+    "cultivo": ["Cultivo", "Cultivos", "NombreCultivo"],
+    "plaga": ["Plaga", "Plagas", "Agente", "NombrePlaga"],
+    "sustancia": ["Sustancia", "Sustancias", "NombreSustancia"],
+}
+VIEW_COLLECTIONS = {"cultivo": "regfi_view_cultivos", "sustancia": "regfi_view_sustancias"}
+
+def _slug(text: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", _fold(text)).strip("-")[:200]
+
+def _ref_names(value: Any) -> List[str]:
+    """Nombres de un campo de referencia: string, lista, o dict con un campo 'Nombre...'."""
+    if isinstance(value, str):
+        return [value.strip()] if value.strip() else []
+    if isinstance(value, list):
+        return [n for v in value for n in _ref_names(v)]
+    if isinstance(value, dict):
+        for k, v in value.items():
+            if str(k).lower().startswith("nombre") and isinstance(v, str) and v.strip():
+                return [v.strip()]
+    return []
+
+def _refs_under(node: Any, keys: Iterable[str]) -> List[str]:
+    """_ref_names de todas las claves 'keys' a cualquier profundidad de 'node'."""
+    wanted = {k.lower() for k in keys}
+    names: List[str] = []
+    stack = [node]
+    while stack:
+        cur = stack.pop()
+        if isinstance(cur, dict):
+            for k, v in cur.items():
+                if str(k).lower() in wanted:
+                    names.extend(_ref_names(v))
+                else:
+                    stack.append(v)
+        elif isinstance(cur, list):
+            stack.extend(cur)
+    return names
+
+def _product_refs(data: Any) -> Dict[str, Dict[str, Any]]:
+    """
+    {"cultivo": {slug: {"nombre", "plagas": {slug: nombre}}}, "sustancia": {slug: nombre}}.
+    Las plagas se asocian al cultivo cuando vienen en el mismo objeto (p.ej. cada uso).
+    """
+    crop_keys = {k.lower() for k in VIEW_FIELDS["cultivo"]}
+    cultivos: Dict[str, Dict[str, Any]] = {}
+    stack = [data]
+    while stack:
+        cur = stack.pop()
+        if isinstance(cur, dict):
+            crop_fields = [v for k, v in cur.items() if str(k).lower() in crop_keys]
+            if crop_fields:
+                plagas = {_slug(n): n for n in _refs_under(cur, VIEW_FIELDS["plaga"]) if _slug(n)}
+                for name in (n for v in crop_fields for n in _ref_names(v)):
+                    if _slug(name):
+                        entry = cultivos.setdefault(_slug(name), {"nombre": name, "plagas": {}})
+                        entry["plagas"].update(plagas)
+            stack.extend(v for k, v in cur.items() if str(k).lower() not in crop_keys)
+        elif isinstance(cur, list):
+            stack.extend(cur)
+    sustancias = {_slug(n): n for n in _refs_under(data, VIEW_FIELDS["sustancia"]) if _slug(n)}
+    return {"cultivo": cultivos, "sustancia": sustancias}
+
+def _view_pages(kind: str, productos: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Parte 'productos' en páginas de ~VIEW_PAGE_BYTES (tamaño estimado como JSON)."""
+    pages: List[Dict[str, Any]] = []
+    page: Dict[str, Any] = {}
+    size = 0
+    for pid in sorted(productos):
+        entry = productos[pid]
+        cost = len(pid) + len(json.dumps(entry, ensure_ascii=False)) + 8
+        if kind == "cultivo":
+            cost += (len(pid) + 4) * len(entry["plagas"])  # su sitio en 'porPlaga'
+        if page and size + cost > VIEW_PAGE_BYTES:
+            pages.append(page)
+            page, size = {}, 0
+        page[pid] = entry
+        size += cost
+    if page:
+        pages.append(page)
+    out: List[Dict[str, Any]] = []
+    for page in pages:
+        data: Dict[str, Any] = {"productos": page}
+        if kind == "cultivo":
+            # Índice plaga -> productos de la página, para filtrar sin recorrerlos todos
+            por_plaga: Dict[str, List[str]] = {}
+            for pid, entry in page.items():
+                for plaga in entry["plagas"]:
+                    por_plaga.setdefault(plaga, []).append(pid)
+            data["porPlaga"] = {k: sorted(v) for k, v in por_plaga.items()}
+        out.append(data)
+    return out
+
+def build_cross_views(db, product_ids: List[str], collection: str = "regfi_productos") -> Dict[str, int]:
+    """Recalcula las vistas afectadas por 'product_ids' (añadidos, cambiados o borrados)."""
+    col = db.collection(collection)
+    stats = {"products": 0, "views": 0, "pages": 0, "deleted": 0}
+    for chunk in _chunked(product_ids, HISTORY_READ_BATCH * 5):
+        products = {snap.id: (snap.to_dict() or {}) for snap in db.get_all([col.document(i) for i in chunk])}
+        new_refs: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        labels: Dict[str, str] = {}
+        # vista -> productos del chunk que estaban o van a estar en ella
+        members: Dict[str, Dict[str, set]] = {kind: {} for kind in VIEW_COLLECTIONS}
+        for pid in chunk:
+            doc = products.get(pid) or {}
+            alive = bool(doc) and not doc.get("removedAt")
+            refs = _product_refs(doc.get("data")) if alive else {"cultivo": {}, "sustancia": {}}
+            new_refs[pid] = refs
+            labels[pid] = _label(doc.get("data"), ["NombreComercial", "Nombre"], pid)
+            old = doc.get("viewRefs") or {}
+            for kind in VIEW_COLLECTIONS:
+                for key in set(old.get(kind) or ()) | set(refs[kind]):
+                    members[kind].setdefault(key, set()).add(pid)
+
+        writes: List[Tuple[Any, Dict[str, Any]]] = []
+        deletes: List[Any] = []
+        for kind, keymap in members.items():
+            view_col = db.collection(VIEW_COLLECTIONS[kind])
+            view_refs = [view_col.document(k) for k in sorted(keymap)]
+            views = {snap.id: (snap.to_dict() or {}) for snap in db.get_all(view_refs) if snap.exists}
+            page_refs = [
+                view_col.document(k).collection("pages").document(f"{i:03d}")
+                for k, view in views.items() for i in range(view.get("pages") or 0)
+            ]
+            old_pages: Dict[str, Dict[str, Any]] = {
+                snap.reference.path: (snap.to_dict() or {}) for snap in db.get_all(page_refs) if snap.exists
+            }
+            for ref in view_refs:
+                view = views.get(ref.id) or {}
+                pages = [
+                    old_pages.get(ref.collection("pages").document(f"{i:03d}").path) or {}
+                    for i in range(view.get("pages") or 0)
+                ]
+                productos: Dict[str, Any] = dict(view.get("productos") or {})  # vistas de antes de paginar
+                for page in pages:
+                    productos.update(page.get("productos") or {})
+                nombres = dict(view.get("nombres") or {})
+                root: Dict[str, Any] = {}
+                for pid in keymap[ref.id]:
+                    productos.pop(pid, None)
+                    refs = new_refs[pid]
+                    if ref.id not in refs[kind]:
+                        continue
+                    if kind == "cultivo":
+                        crop = refs["cultivo"][ref.id]
+                        root["cultivo"] = crop["nombre"]
+                        productos[pid] = {
+                            "nombre": labels[pid],
+                            "plagas": sorted(crop["plagas"]),
+                            "sustancias": sorted(refs["sustancia"]),
+                        }
+                        nombres.update(crop["plagas"])
+                        nombres.update(refs["sustancia"])
+                    else:
+                        root["sustancia"] = refs["sustancia"][ref.id]
+                        productos[pid] = {"nombre": labels[pid], "cultivos": sorted(refs["cultivo"])}
+                        nombres.update({k: c["nombre"] for k, c in refs["cultivo"].items()})
+                if not productos:
+                    if ref.id in views:
+                        deletes.extend(ref.collection("pages").document(f"{i:03d}") for i in range(len(pages)))
+                        deletes.append(ref)
+                        stats["deleted"] += 1
+                    continue
+                new_pages = _view_pages(kind, productos)
+                for i, page in enumerate(new_pages):
+                    if i >= len(pages) or pages[i] != page:
+                        writes.append((ref.collection("pages").document(f"{i:03d}"), page))
+                        stats["pages"] += 1
+                deletes.extend(ref.collection("pages").document(f"{i:03d}") for i in range(len(new_pages), len(pages)))
+                used = {k for entry in productos.values() for field in ("plagas", "sustancias", "cultivos")
+                        for k in entry.get(field, ())}
+                root["nombres"] = {k: v for k, v in nombres.items() if k in used}
+                root["productosCount"] = len(productos)
+                root["pages"] = len(new_pages)
+                root["updatedAt"] = _utc_now_iso()
+                for legacy in ("productos", "porPlaga"):
+                    if legacy in view:
+                        root[legacy] = None
+                writes.append((ref, root))
+                stats["views"] += 1
+
+        for pid, refs in new_refs.items():
+            if products.get(pid):
+                writes.append((col.document(pid), {
+                    "viewRefs": {kind: sorted(refs[kind]) for kind in VIEW_COLLECTIONS},
+                }))
+        _commit_writes(db, writes)
+        # Después de escribir: una vista nunca apunta a páginas que ya no existen
+        for ref in deletes:
+            ref.delete()
+        stats["products"] += len(chunk)
+    return stats
+
+def update_cross_views(db) -> Optional[Dict[str, int]]:
+    """
+    Aplica a las vistas los snapshots de VIEW_SOURCE finalizados después del último aplicado
+    (los de esta ejecución y los que quedaran de otra) y avanza la marca. None si no hay ninguno.
+    """
+    state_ref = db.collection(VIEW_STATE).document(VIEW_SOURCE)
+    state = state_ref.get().to_dict() or {}
+    query = db.collection("regfi_snapshots").where("endpoint", "==", VIEW_SOURCE)
+    if state.get("appliedCreatedAt"):
+        query = query.where("createdAt", ">", state["appliedCreatedAt"])
+    # Sin marca (la primera vez) se aplican todos: reconstruye (y pagina) todas las vistas
+    pending = [(d.id, d.to_dict() or {}) for d in query.order_by("createdAt", direction="DESCENDING").stream()]
+    pending = [(i, d) for i, d in reversed(pending) if d.get("finalizedAt")]
+    if not pending:
+        return None
+    ids: Dict[str, None] = {}
+    for snap_id, data in pending:
+        if data.get("touchedShards"):
+            ids.update(dict.fromkeys(_load_touched(db.collection("regfi_snapshots").document(snap_id))))
+    last_id, last = pending[-1]
+    stats = build_cross_views(db, list(ids), last.get("collection") or "regfi_productos") if ids else {}
+    state_ref.set({
+        "appliedSnapshotId": last_id,
+        "appliedCreatedAt": last["createdAt"],
+        "updatedAt": _utc_now_iso(),
+    })
+    return {**stats, "snapshots": len(pending)}
+
+def _post_ingest(totals: List[Dict[str, Any]], endpoints: List[dict]) -> Dict[str, Any]:
+    """
+    Etapas que dependen de todos los endpoints. Las vistas se ponen al día siempre (puede
+    haber snapshots pendientes de una ejecución anterior); el índice, solo si algo cambió,
+    y no se construye aquí: se encola en SEARCH_QUEUE_FUNCTION.
+    """
+    db = _get_db()
+    metrics = _Metrics()
+    out: Dict[str, Any] = {}
+    try:
+        with metrics.stage("crossViews"):
+            views = update_cross_views(db)
+        if views:
+            out["crossViews"] = views
+    except Exception as e:
+        print(f"[post_ingest][ERROR] vistas cruzadas: {e}")
+        out["crossViewsError"] = str(e)
+    changed = sum(r.get("addedCount", 0) + r.get("changedCount", 0) + r.get("removedCount", 0) for r in totals)
+    if not changed:
+        return {**out, "skipped": True}
+    try:
+        # El índice va en su propia tarea; aquí solo se marcan las partes a reconstruir
+        dirty = [r["endpoint"] for r in totals if r.get("addedCount") or r.get("changedCount") or r.get("removedCount")]
+        _mark_search_dirty(db, dirty)
+        key = hashlib.sha1(",".join(sorted(r["snapshotId"] for r in totals)).encode()).hexdigest()[:20]
+        out["searchIndex"] = {"dirty": dirty, "queued": _enqueue_task(SEARCH_QUEUE_FUNCTION, {"endpoints": dirty}, f"search-{key}")}
+    except Exception as e:
+        print(f"[post_ingest][ERROR] índice de búsqueda: {e}")
+        out["searchIndexError"] = str(e)
+    summary = metrics.summary()
+    out["stagesSec"] = summary["stagesSec"]
+    _log("regfi_post_ingest_metrics", **summary)
+    return out
+
+# Tareas por función de la cola (para REGFI_TASKS_INLINE)
+_TASK_HANDLERS: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+    TASK_QUEUE_FUNCTION: run_part,
+    FINALIZE_QUEUE_FUNCTION: finalize_run,
+    SEARCH_QUEUE_FUNCTION: rebuild_search_index,
+}
 
 # ---------- Triggers ----------
 
 # Opción 1: PROGRAMADA (semanal, lunes 06:00 Europe/Madrid)
-@scheduler_fn.on_schedule(schedule="0 6 * * 1", timezone="Europe/Madrid")
+@scheduler_fn.on_schedule(schedule="0 6 * * 1", timezone="Europe/Madrid", timeout_sec=INGEST_TIMEOUT_SEC)
 def regfi_snapshot_weekly(_: scheduler_fn.ScheduledEvent) -> None:
-    totals = []
-    for ep in ENDPOINTS:
-        try:
-            payload = fetch_and_parse(ep)
-            result = save_snapshot_and_items(payload, ep)
-            print(f"[weekly] {result['endpoint']} → {result['itemsCount']} items (snap {result['snapshotId']})")
-            totals.append(result)
-        except Exception as e:
-            print(f"[weekly][ERROR] {ep.get('name')} ({ep.get('url')}): {e}")
+    if INGEST_MODE == "tasks":
+        run_id = plan_run(_endpoints())
+        print(f"[weekly] ejecución {run_id} planificada: {len(_endpoints())} partes en {TASK_QUEUE_FUNCTION}")
+        return
+    totals, errors = run_snapshot(_endpoints())
+    for result in totals:
+        if result.get("skipped"):
+            print(f"[weekly] {result['endpoint']} → sin cambios (igual que {result['sameAsSnapshotId']})")
+            continue
+        print(
+            f"[weekly] {result['endpoint']} → {result['itemsCount']} items "
+            f"(+{result['addedCount']} ~{result['changedCount']} -{result['removedCount']}, "
+            f"snap {result['snapshotId']})"
+        )
+    for err in errors:
+        print(f"[weekly][ERROR] {err['endpoint']} ({err['url']}): {err['error']}")
     print(json.dumps({"ok": True, "totals": totals}, ensure_ascii=False))
 
+# AEMET: pre-calentado de la caché (00:05, 06:05, 12:05 y 18:05 Europe/Madrid)
+@scheduler_fn.on_schedule(schedule="5 0,6,12,18 * * *", timezone="Europe/Madrid", timeout_sec=AEMET_PREWARM_TIMEOUT_SEC)
+def aemet_prewarm(_: scheduler_fn.ScheduledEvent) -> None:
+    run = prewarm_aemet(AEMET_CCAA, _get_secret("AEMET_API_KEY"))
+    for r in run["results"]:
+        if not r["ok"]:
+            print(f"[aemet_prewarm][ERROR] {r['ccaa']} ({r['attempts']} intentos): {r['error']}")
+    print(json.dumps({"ok": run["failedCount"] == 0, **run}, ensure_ascii=False))
+
 # Opción 2: HTTP manual (útil para pruebas o cron externo)
-@https_fn.on_request()
+@https_fn.on_request(timeout_sec=INGEST_TIMEOUT_SEC)
 def regfi_snapshot_http(req: https_fn.Request) -> https_fn.Response:
+    # ?full=1 fuerza la reescritura de todos los items (ignora el diff)
+    incremental = None if req.args.get("full") not in ("1", "true") else False
+    # ?mode=tasks planifica una ejecución por tareas en vez de hacerla aquí
+    if req.args.get("mode") == "tasks":
+        try:
+            run_id = plan_run(_endpoints(), incremental=incremental)
+        except Exception as e:
+            return _http_response(req, json.dumps({"ok": False, "error": str(e)}, ensure_ascii=False), status=500, cors=False)
+        return _http_response(req, json.dumps({"ok": True, "runId": run_id}, ensure_ascii=False), status=202, cors=False)
     try:
-        totals = []
-        for ep in ENDPOINTS:
-            payload = fetch_and_parse(ep)
-            result = save_snapshot_and_items(payload, ep)
-            totals.append(result)
-        return https_fn.Response(
-            json.dumps({"ok": True, "totals": totals}, ensure_ascii=False),
-            mimetype="application/json",
-            status=200,
-        )
+        totals, errors = run_snapshot(_endpoints(), incremental=incremental)
     except Exception as e:
-        return https_fn.Response(
-            json.dumps({"ok": False, "error": str(e)}, ensure_ascii=False),
-            mimetype="application/json",
-            status=500,
-        )
+        return _http_response(req, json.dumps({"ok": False, "error": str(e)}, ensure_ascii=False), status=500, cors=False)
+    # Sin 'cache': cada llamada lanza una ingesta, nada que guardar en el CDN
+    return _http_response(
+        req,
+        json.dumps({"ok": not errors, "totals": totals, "errors": errors}, ensure_ascii=False),
+        status=500 if errors else 200,
+        cors=False,
+    )
+
+# Opción 3: tarea de ingesta (una parte = un endpoint, reanudable por checkpoints)
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=5, min_backoff_seconds=30),
+    rate_limits=RateLimits(max_concurrent_dispatches=ENDPOINT_WORKERS),
+    timeout_sec=TASK_TIMEOUT_SEC,
+)
+def regfi_ingest_task(req: tasks_fn.CallableRequest) -> None:
+    run_part(req.data)
+
+# Finalización de una ejecución por tareas (vistas + índice), reintentable
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=5, min_backoff_seconds=60),
+    rate_limits=RateLimits(max_concurrent_dispatches=1),
+    timeout_sec=FINALIZE_TIMEOUT_SEC,
+)
+def regfi_finalize_task(req: tasks_fn.CallableRequest) -> None:
+    finalize_run(req.data)
+
+# Índice de búsqueda (lo encola _post_ingest); de uno en uno, reintentable
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=3, min_backoff_seconds=60),
+    rate_limits=RateLimits(max_concurrent_dispatches=1),
+    timeout_sec=SEARCH_INDEX_TIMEOUT_SEC,
+)
+def regfi_search_index_task(req: tasks_fn.CallableRequest) -> None:
+    rebuild_search_index(req.data)
+
 # ---------- Endpoint AEMET CCAA (hoy) ----------
 @https_fn.on_request()
 def aemet_ccaa_hoy(req: https_fn.Request) -> https_fn.Response:
@@ -388,6 +2896,10 @@ def aemet_ccaa_hoy(req: https_fn.Request) -> https_fn.Response:
       - Ruta con segmento final:  /aemet/ccaa/<CCAA>
         Ej: https://.../aemet_ccaa_hoy/aemet/ccaa/MU
       - Query string:            ?ccaa=MU
+      - Varias CCAA (separadas por coma) o '*' para todas:
+        /aemet/ccaa/MUR,AND,VAL   ?ccaa=MUR,AND,VAL   ?ccaa=*
+        -> {"ok", "ccaa": [...], "regions": {CCAA: {"ok", "cache", "data"} | {"ok": false, "error"}}, "errorsCount"}
+           200 si al menos una región responde; errores parciales dentro de 'regions'.
 
     Devuelve JSON.
     """
@@ -409,12 +2921,88 @@ def aemet_ccaa_hoy(req: https_fn.Request) -> https_fn.Response:
         ccaa = req.args.get("ccaa")
 
     if not ccaa:
-        return _cors_response(json.dumps({"ok": False, "error": "Falta parámetro CCAA (en ruta o ?ccaa=)"}), status=400)
+        return _http_response(req, json.dumps({"ok": False, "error": "Falta parámetro CCAA (en ruta o ?ccaa=)"}), status=400)
+
+    if "," in ccaa or ccaa.strip() == "*":
+        return _aemet_batch_response(req, ccaa)
 
     try:
         api_key = _resolve_aemet_key(req)
-        data = _fetch_aemet_ccaa_hoy(ccaa.upper(), api_key)
-        return _cors_response(json.dumps(data, ensure_ascii=False))
+        data, cache_status = _get_aemet_ccaa_hoy(ccaa.upper(), api_key)
+        return _http_response(
+            req,
+            json.dumps(data, ensure_ascii=False),
+            headers={"X-Cache": cache_status},
+            cache=_aemet_cache_control(ccaa.upper(), cache_status),
+        )
     except Exception as e:
         err = {"ok": False, "error": str(e), "ccaa": ccaa}
-        return _cors_response(json.dumps(err, ensure_ascii=False), status=500)
\ No newline at end of file
+        return _http_response(req, json.dumps(err, ensure_ascii=False), status=500)
+
+def _aemet_batch_response(req: https_fn.Request, value: str) -> https_fn.Response:
+    codes = _parse_ccaa_list(value)
+    if not codes:
+        return _http_response(req, json.dumps({"ok": False, "error": "Lista de CCAA vacía"}), status=400)
+    if len(codes) > max(len(AEMET_CCAA), 1):
+        return _http_response(
+            req, json.dumps({"ok": False, "error": f"Como mucho {len(AEMET_CCAA)} CCAA por petición"}), status=400,
+        )
+    try:
+        regions = _get_aemet_ccaa_batch(codes, _resolve_aemet_key(req))
+    except Exception as e:
+        return _http_response(req, json.dumps({"ok": False, "error": str(e), "ccaa": codes}, ensure_ascii=False), status=500)
+    errors = sum(1 for r in regions.values() if not r["ok"])
+    body = {"ok": errors == 0, "ccaa": codes, "regions": regions, "errorsCount": errors}
+    cache_status = ", ".join(f"{code}={r.get('cache', 'ERROR')}" for code, r in regions.items())
+    return _http_response(
+        req,
+        json.dumps(body, ensure_ascii=False),
+        status=500 if errors == len(codes) else 200,
+        headers={"X-Cache": cache_status},
+        cache=_aemet_batch_cache_control(regions),
+    )
+
+# ---------- Búsqueda REGFI ----------
+@https_fn.on_request()
+def regfi_search(req: https_fn.Request) -> https_fn.Response:
+    """
+    Búsqueda/typeahead sobre el índice en memoria.
+
+    Parámetros (query string):
+      - q:          texto libre; cada palabra casa por prefijo en cualquier campo
+      - nombre, titular, registro, sustancia, cultivo, plaga, latin, eppo:
+                    filtros por campo (mismo criterio de prefijo)
+      - tipo:       productos,formulados,sustancias,cultivos (separados por coma)
+      - limit:      máximo de resultados (por defecto 20, tope 100)
+    Ej: ?q=cobre&cultivo=vid&tipo=productos
+    """
+    if req.method == "OPTIONS":
+        return _cors_response("", status=204)
+
+    started = time.monotonic()
+    q = (req.args.get("q") or "").strip()
+    tipos = {t.strip() for t in (req.args.get("tipo") or "").split(",") if t.strip()} or None
+    try:
+        limit = max(1, min(int(req.args.get("limit") or 20), SEARCH_MAX_LIMIT))
+    except ValueError:
+        limit = 20
+
+    try:
+        index = _get_search_index()
+        if index is None:
+            return _http_response(req, json.dumps({"ok": False, "error": "Índice de búsqueda no disponible"}), status=503)
+        filters = {g: req.args[g] for g in index.groups if req.args.get(g)}
+        if not q and not filters:
+            return _http_response(req, json.dumps({"ok": False, "error": "Falta ?q= o algún filtro"}), status=400)
+        total, results = index.search(q, filters, tipos, limit)
+        body = {"ok": True, "version": index.version, "total": total, "results": results}
+        # El tiempo va en Server-Timing y no en el cuerpo: así el ETag no cambia en cada petición
+        took_ms = round((time.monotonic() - started) * 1000, 2)
+        return _http_response(
+            req,
+            json.dumps(body, ensure_ascii=False),
+            headers={"Server-Timing": f"search;dur={took_ms}"},
+            cache=(SEARCH_HTTP_MAX_AGE, SEARCH_HTTP_S_MAXAGE),
+        )
+    except Exception as e:
+        return _http_response(req, json.dumps({"ok": False, "error": str(e)}, ensure_ascii=False), status=500)
@@ -0,0 +1,223 @@
+"""
+Caché de AEMET (memoria + un Firestore de diccionario) con la descarga de AEMET
+sustituida: single-flight, stale-while-revalidate, limpieza de días anteriores y
+peticiones de varias CCAA.
+
+Uso (desde functions/, con el venv de las functions activado):
+    python -m unittest discover -s tests
+"""
+from __future__ import annotations
+
+import os
+import sys
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+import main  # noqa: E402
+
+
+class FakeDb:
+    """Lo que la caché usa de Firestore: collection(c).document(clave).get() / .set()."""
+
+    def __init__(self) -> None:
+        self.docs = {}
+
+    def collection(self, name: str) -> "FakeDb":
+        return self
+
+    def document(self, key: str) -> SimpleNamespace:
+        return SimpleNamespace(
+            get=lambda: SimpleNamespace(exists=key in self.docs, to_dict=lambda: dict(self.docs[key])),
+            set=lambda data: self.docs.__setitem__(key, dict(data)),
+        )
+
+
+class AemetCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db = FakeDb()
+        self.db_calls = 0
+        self.fetches = []
+        self.release = threading.Event()
+        self.release.set()
+        self.fail = None
+        self.failing = set()   # CCAA cuya descarga falla
+        self.slow = set()      # CCAA cuya descarga espera a self.release
+        self.delay = 0.0
+        self.active = self.max_active = 0
+        lock = threading.Lock()
+
+        def get_db():
+            self.db_calls += 1
+            return self.db
+
+        def fetch(ccaa, api_key):
+            with lock:
+                self.fetches.append(ccaa)
+                n = len(self.fetches)
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            try:
+                self.release.wait(5)
+                if ccaa in self.slow:
+                    self.slow_release.wait(5)
+                time.sleep(self.delay)
+                if self.fail or ccaa in self.failing:
+                    raise self.fail or RuntimeError(f"404 Client Error: {ccaa}")
+                return {"ccaa": ccaa, "n": n}
+            finally:
+                with lock:
+                    self.active -= 1
+
+        self.slow_release = threading.Event()
+        self.addCleanup(self.slow_release.set)
+
+        main._aemet_mem.clear()
+        main._aemet_inflight.clear()
+        for target, value in (("_get_db", get_db), ("_fetch_aemet_ccaa_hoy", fetch)):
+            patcher = mock.patch.object(main, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.offset = 0.0
+        clock = time.time
+        patcher = mock.patch("time.time", lambda: clock() + self.offset)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def concurrently(self, n: int, fn) -> list:
+        """Lanza n llamadas mientras la descarga está parada; devuelve resultados o excepciones."""
+        self.release.clear()
+        results = [None] * n
+
+        def run(i):
+            try:
+                results[i] = fn()
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+        for t in threads:
+            t.start()
+        time.sleep(0.2)  # todas esperando a la misma descarga
+        self.release.set()
+        for t in threads:
+            t.join(5)
+        return results
+
+    def test_single_flight(self) -> None:
+        key = main._aemet_cache_key("MUR")
+        results = self.concurrently(5, lambda: main._aemet_fetch_once(key, "MUR", "k"))
+        self.assertEqual(self.fetches, ["MUR"])
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(main._aemet_inflight, {})
+
+    def test_leader_failure_reaches_waiters(self) -> None:
+        key = main._aemet_cache_key("MUR")
+        self.fail = RuntimeError("503 Service Unavailable")
+        results = self.concurrently(4, lambda: main._aemet_fetch_once(key, "MUR", "k"))
+        self.assertEqual(self.fetches, ["MUR"])
+        self.assertTrue(all(r is self.fail for r in results))
+        self.assertEqual(main._aemet_inflight, {})
+        self.assertNotIn(key, main._aemet_mem)
+
+        self.fail = None  # la siguiente petición vuelve a intentarlo
+        self.assertEqual(main._aemet_fetch_once(key, "MUR", "k")["data"]["n"], 2)
+
+    def test_stale_served_while_refreshing(self) -> None:
+        key = main._aemet_cache_key("MUR")
+        main._aemet_cache_put(key, "MUR", {"n": 0})
+        self.offset = main.AEMET_CACHE_TTL_SEC + 60
+        self.release.clear()
+        self.db_calls = 0
+
+        self.assertEqual(main._get_aemet_ccaa_hoy("MUR", "k"), ({"n": 0}, "STALE"))
+        self.assertEqual(self.db_calls, 1)  # mira si otra instancia ya la refrescó
+        for _ in range(3):
+            self.assertEqual(main._get_aemet_ccaa_hoy("MUR", "k"), ({"n": 0}, "STALE"))
+        self.assertEqual(self.db_calls, 1)  # con el refresco en curso ya no
+        self.assertEqual(self.fetches, ["MUR"])
+
+        self.release.set()
+        for _ in range(50):
+            if key not in main._aemet_inflight:
+                break
+            time.sleep(0.05)
+        data, status = main._get_aemet_ccaa_hoy("MUR", "k")
+        self.assertEqual((data["n"], status), (1, "HIT"))
+
+    def test_stale_error_falls_back(self) -> None:
+        main._aemet_cache_put(main._aemet_cache_key("MUR"), "MUR", {"n": 0})
+        self.offset = main.AEMET_CACHE_MAX_STALE_SEC + 60
+        self.fail = RuntimeError("timeout")
+        self.assertEqual(main._get_aemet_ccaa_hoy("MUR", "k"), ({"n": 0}, "STALE-ERROR"))
+
+    def test_earlier_days_evicted(self) -> None:
+        main._aemet_cache_put("MUR_2026-03-01", "MUR", {"n": 1})
+        main._aemet_cache_put("AND_2026-03-01", "AND", {"n": 1})
+        main._aemet_cache_put("MUR_2026-03-02", "MUR", {"n": 2})
+        self.assertEqual(set(main._aemet_mem), {"MUR_2026-03-02"})
+        # Leer ayer (fallback) no tira hoy
+        main._aemet_cache_get("AND_2026-03-01")
+        self.assertEqual(set(main._aemet_mem), {"MUR_2026-03-02", "AND_2026-03-01"})
+        main._aemet_cache_put("AND_2026-03-02", "AND", {"n": 2})
+        self.assertEqual(set(main._aemet_mem), {"MUR_2026-03-02", "AND_2026-03-02"})
+
+    # ---------- Varias CCAA en una petición ----------
+
+    def test_batch_partial_errors(self) -> None:
+        main._aemet_cache_put(main._aemet_cache_key("VAL"), "VAL", {"n": 0})
+        self.failing = {"AND"}
+        regions = main._get_aemet_ccaa_batch(["MUR", "X1", "AND", "VAL"], "k")
+        self.assertEqual(list(regions), ["MUR", "X1", "AND", "VAL"])
+        self.assertEqual((regions["MUR"]["ok"], regions["MUR"]["cache"]), (True, "MISS"))
+        self.assertEqual(regions["X1"], {"ok": False, "error": "Código de CCAA no válido"})
+        self.assertEqual(regions["AND"], {"ok": False, "error": "404 Client Error: AND"})
+        self.assertEqual(regions["VAL"], {"ok": True, "cache": "HIT", "data": {"n": 0}})
+        self.assertEqual(sorted(self.fetches), ["AND", "MUR"])
+        self.assertIsNone(main._aemet_batch_cache_control(regions))  # una falla: sin caché
+
+        self.failing = set()
+        regions = main._get_aemet_ccaa_batch(["MUR", "VAL"], "k")
+        self.assertEqual([r["cache"] for r in regions.values()], ["HIT", "HIT"])
+        max_age, s_maxage = main._aemet_batch_cache_control(regions)
+        self.assertLessEqual(max_age, main.AEMET_HTTP_MAX_AGE)
+        self.assertLessEqual(s_maxage, main.AEMET_CACHE_TTL_SEC)
+
+    def test_batch_timeout_keeps_filling_cache(self) -> None:
+        self.slow = {"GAL"}
+        with mock.patch.object(main, "AEMET_BATCH_TIMEOUT_SEC", 0.3):
+            regions = main._get_aemet_ccaa_batch(["GAL", "AST"], "k")
+        self.assertEqual(regions["GAL"], {"ok": False, "error": "Sin respuesta de AEMET en 0.3 s"})
+        self.assertTrue(regions["AST"]["ok"])
+
+        self.slow_release.set()
+        for _ in range(50):
+            if main._aemet_cache_key("GAL") in main._aemet_mem:
+                break
+            time.sleep(0.05)
+        self.assertEqual(main._get_aemet_ccaa_hoy("GAL", "k")[1], "HIT")
+
+    def test_batch_concurrency_per_request(self) -> None:
+        self.delay = 0.2
+        batches = iter([main.AEMET_CCAA[:6], main.AEMET_CCAA[6:12]])
+        with mock.patch.object(main, "AEMET_BATCH_WORKERS", 8):
+            # Dos peticiones a la vez: ninguna espera a los hilos de la otra
+            results = self.concurrently(2, lambda: main._get_aemet_ccaa_batch(next(batches), "k"))
+        self.assertTrue(all(all(r["ok"] for r in regions.values()) for regions in results))
+        self.assertEqual(self.max_active, 12)
+
+        main._aemet_mem.clear()
+        self.max_active = 0
+        with mock.patch.object(main, "AEMET_BATCH_WORKERS", 4):
+            regions = main._get_aemet_ccaa_batch(main.AEMET_CCAA, "k")
+        self.assertTrue(all(r["ok"] for r in regions.values()))
+        self.assertEqual(self.max_active, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+_NestedJsonDecoder da siempre lo mismo que _maybe_decode, aprenda o no rutas nuevas.
+
+Uso (desde functions/, con el venv de las functions activado):
+    python -m unittest discover -s tests
+"""
+from __future__ import annotations
+
+import copy
+import json
+import os
+import random
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+import main  # noqa: E402
+
+# Textos que empiezan como JSON sin serlo, con blancos delante, vacíos, NaN...
+TEXTS = [
+    "[ver etiqueta] uso profesional", "{x}", "[1] nota", "[", '{"a"', "[tru]", "texto", "", " ",
+    " [1, 2]", '\t{"a": 1} ', "\xa0[1]", "[]", "{}", "{ }", '[ "a" ]', "[NaN]", "[-1]", "[true]",
+]
+
+
+def random_value(rnd: random.Random, depth: int = 0):
+    r = rnd.random()
+    if depth > 3 or r < 0.4:
+        c = rnd.random()
+        if c < 0.4:
+            return rnd.choice(TEXTS)
+        if c < 0.8:
+            text = json.dumps(random_value(rnd, depth + 1))
+            return text if rnd.random() < 0.7 else " " + text
+        return rnd.randint(0, 9)
+    if r < 0.7:
+        return {rnd.choice("abcde"): random_value(rnd, depth + 1) for _ in range(rnd.randint(0, 4))}
+    return [random_value(rnd, depth + 1) for _ in range(rnd.randint(0, 3))]
+
+
+class NestedJsonDecoderTest(unittest.TestCase):
+    def assert_same(self, decoder: main._NestedJsonDecoder, item) -> None:
+        expected = main._maybe_decode(copy.deepcopy(item))
+        # json.dumps: NaN != NaN
+        self.assertEqual(json.dumps(decoder.decode(copy.deepcopy(item))), json.dumps(expected), item)
+
+    def test_learned_paths_only(self) -> None:
+        item = {
+            "Nombre": "[ver etiqueta] uso profesional",
+            "Sustancias": json.dumps([{"Nombre": "azufre"}]),
+            "Usos": json.dumps([{"Cultivo": "Vid", "Plagas": json.dumps(["oidio"])}]),
+        }
+        learner = main._NestedJsonDecoder()
+        self.assert_same(learner, item)
+        self.assertEqual(learner.paths, {("Sustancias",), ("Usos",), ("Usos", "*", "Plagas")})
+
+        decoder = main._NestedJsonDecoder(learner.paths)
+        for _ in range(3):
+            self.assert_same(decoder, item)
+        self.assertEqual((decoder.rescans, decoder.changed), (0, False))
+
+        # Una ruta nueva en un item cualquiera: se decodifica y pasa al esquema
+        self.assert_same(decoder, {**item, "Extra": ' {"a": "[1]"}'})
+        self.assertEqual((decoder.rescans, decoder.changed), (1, True))
+        self.assertIn(("Extra",), decoder.paths)
+
+    def test_random_items_match_full_scan(self) -> None:
+        rnd = random.Random(4)
+        decoder = main._NestedJsonDecoder()
+        for _ in range(3000):
+            item = {k: random_value(rnd, 1) for k in "abcdef"} if rnd.random() < 0.9 else random_value(rnd)
+            self.assert_same(decoder, item)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+Respuestas HTTP negociadas (_http_response): codificación por Accept-Encoding con
+q-values, ETag / If-None-Match -> 304 y Cache-Control, sin red ni Firestore.
+
+Uso (desde functions/, con el venv de las functions activado):
+    python -m unittest discover -s tests
+"""
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+from flask import Request
+from werkzeug.test import EnvironBuilder
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+import main  # noqa: E402
+
+BODY = json.dumps({"ok": True, "items": [f"producto {i}" for i in range(200)]})
+
+
+def request(**headers: str) -> Request:
+    return EnvironBuilder(path="/", headers={k.replace("_", "-"): v for k, v in headers.items()}).get_request(cls=Request)
+
+
+class EtagMatchesTest(unittest.TestCase):
+    def test_forms(self) -> None:
+        digest = "0123abcd"
+        for header in (
+            '"0123abcd"', '"0123abcd-gzip"', '"0123abcd-br"', 'W/"0123abcd-gzip"',
+            '"otro", W/"0123abcd"', '  "otro" ,"0123abcd-br" ', "*", " * ",
+        ):
+            self.assertTrue(main._etag_matches(header, digest), header)
+        for header in ('"otro"', '"0123abcde"', '"0123abc"', 'W/"x-0123abcd"', ""):
+            self.assertFalse(main._etag_matches(header, digest), header)
+
+
+class PickEncodingTest(unittest.TestCase):
+    def test_q_values(self) -> None:
+        cases = {
+            "": None,
+            "identity": None,
+            "gzip": "gzip",
+            "gzip, deflate, br": "br",
+            "br;q=0.5, gzip": "gzip",
+            "gzip;q=0.5, br;q=0.8": "br",
+            "gzip;q=0, br;q=0": None,
+            "GZIP;Q=1": "gzip",
+            "*": "br",
+            "*;q=0.2, br;q=0": "gzip",
+            "gzip;q=abc": None,
+        }
+        for header, expected in cases.items():
+            self.assertEqual(main._pick_encoding(request(Accept_Encoding=header)), expected, header)
+
+    def test_without_brotli(self) -> None:
+        with mock.patch.object(main, "brotli", None):
+            self.assertEqual(main._pick_encoding(request(Accept_Encoding="br, gzip;q=0.1")), "gzip")
+            self.assertIsNone(main._pick_encoding(request(Accept_Encoding="br")))
+
+
+class HttpResponseTest(unittest.TestCase):
+    def test_gzip_etag_and_cache_control(self) -> None:
+        resp = main._http_response(request(Accept_Encoding="gzip"), BODY, cache=(60, 300))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(resp.get_data()).decode(), BODY)
+        self.assertTrue(resp.headers["ETag"].endswith('-gzip"'))
+        self.assertEqual(resp.headers["Cache-Control"], "public, max-age=60, s-maxage=300")
+        self.assertEqual(resp.headers["Vary"], "Accept-Encoding")
+        self.assertEqual(resp.headers["Access-Control-Allow-Origin"], "*")
+
+    def test_not_modified_across_encodings(self) -> None:
+        etag = main._http_response(request(Accept_Encoding="gzip"), BODY).headers["ETag"]
+        digest = etag.strip('"').rsplit("-", 1)[0]
+        for inm, accept in ((etag, "gzip"), (f"W/{etag}", "gzip"), (f'"{digest}"', "br"), (etag, ""), ("*", "gzip")):
+            resp = main._http_response(request(Accept_Encoding=accept, If_None_Match=inm), BODY, cache=(60, 300))
+            self.assertEqual(resp.status_code, 304, (inm, accept))
+            self.assertEqual(resp.get_data(), b"")
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertIn("ETag", resp.headers)
+            self.assertEqual(resp.headers["Cache-Control"], "public, max-age=60, s-maxage=300")
+
+        changed = main._http_response(request(If_None_Match=etag), BODY.replace("producto", "Producto"))
+        self.assertEqual(changed.status_code, 200)
+
+    def test_small_bodies_not_compressed(self) -> None:
+        resp = main._http_response(request(Accept_Encoding="gzip, br"), '{"ok": true}')
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.get_data(), b'{"ok": true}')
+        self.assertNotIn("-", resp.headers["ETag"])
+
+    def test_errors_never_cached(self) -> None:
+        for status in (400, 500, 503):
+            resp = main._http_response(request(If_None_Match="*"), BODY, status=status, cache=(60, 300))
+            self.assertEqual(resp.status_code, status)  # sin 304 ni ETag
+            self.assertEqual(resp.headers["Cache-Control"], "no-store")
+            self.assertNotIn("ETag", resp.headers)
+        resp = main._http_response(request(), BODY)  # sin 'cache'
+        self.assertEqual(resp.headers["Cache-Control"], "no-store")
+
+    def test_without_cors(self) -> None:
+        resp = main._http_response(request(), BODY, status=202, cors=False)
+        self.assertEqual(resp.status_code, 202)
+        self.assertNotIn("Access-Control-Allow-Origin", resp.headers)
+
+
+if __name__ == "__main__":
+    unittest.main()
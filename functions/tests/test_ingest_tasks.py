@@ -0,0 +1,313 @@
+"""
+Ingesta por tareas sobre el Firestore en memoria de bench/fakefs.py, con las tareas en
+el propio proceso (REGFI_TASKS_INLINE=1) y el export servido sin red.
+
+Uso (desde functions/, con el venv de las functions activado):
+    python -m unittest discover -s tests
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sys
+import unittest
+import zlib
+from unittest import mock
+
+os.environ["REGFI_TASKS_INLINE"] = "1"
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, os.path.join(HERE, "..", "bench"))
+
+import main  # noqa: E402
+from fakefs import FakeFirestore  # noqa: E402
+
+SIZES = {"productos": 1200, "formulados": 60, "sustancias": 10, "cultivos": 900}
+SHARD = 200
+BATCH = 50
+
+
+def export_body(name: str, version: int = 0) -> bytes:
+    items = [
+        {"NumRegistro": i, "IdFormulado": i, "IdSustancia": i, "CodigoEppo": f"E{i:05d}",
+         "Nombre": f"{name} {i} v{version}", "Cultivo": "Vid", "Plaga": f"Oidio {i % 7}",
+         "Sustancia": "Azufre", "Detalle": json.dumps({"Orden": i})}
+        for i in range(SIZES[name])
+    ]
+    return json.dumps({"Contenido": items}).encode()
+
+
+def raw_export(body: bytes) -> main._RawExport:
+    data = zlib.compress(body)
+    chunks = [data[i:i + 4096] for i in range(0, len(data), 4096)]  # varios trozos, como el archivo
+    return main._RawExport(chunks, hashlib.sha256(body).hexdigest(), len(body))
+
+
+class CrashingFirestore(FakeFirestore):
+    """Falla una vez el commit nº 'fail_at' que escribe en 'collection'."""
+
+    def __init__(self, collection: str, fail_at: int) -> None:
+        super().__init__()
+        self.collection_path, self.fail_at, self.seen = collection + "/", fail_at, 0
+
+    def batch(self):
+        batch = super().batch()
+        commit = batch.commit
+
+        def crashing_commit():
+            if any(ref.path.startswith(self.collection_path) for _, ref, _, _ in batch._ops):
+                self.seen += 1
+                if self.seen == self.fail_at:
+                    raise RuntimeError("conexión cortada")
+            commit()
+
+        batch.commit = crashing_commit
+        return batch
+
+
+class IngestTasksTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db = FakeFirestore()
+        self.fetches = []
+        self.versions = {}
+        self.post_calls = 0
+        post_ingest = main._post_ingest
+
+        def fetch_export(ep, previous=None):
+            self.fetches.append(ep["name"])
+            return raw_export(export_body(ep["name"], self.versions.get(ep["name"], 0)))
+
+        def counting_post_ingest(totals, endpoints):
+            self.post_calls += 1
+            return post_ingest(totals, endpoints)
+
+        main._inline_tasks.clear()
+        main._inline_task_ids.clear()
+        for target, value in (
+            ("TASKS_INLINE", True),  # por si otro test ha importado main antes que este
+            ("_get_db", lambda: self.db),
+            ("fetch_export", fetch_export),
+            ("_post_ingest", counting_post_ingest),
+            ("MANIFEST_SHARD_SIZE", SHARD),
+            ("BATCH_SIZE", BATCH),
+            ("TASK_BUDGET_SEC", 90),
+        ):
+            patcher = mock.patch.object(main, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_doc(self, run_id: str) -> dict:
+        return self.db.collection("regfi_runs").document(run_id).get().to_dict()
+
+    def snapshot(self, snap_id: str) -> dict:
+        return self.db.collection("regfi_snapshots").document(snap_id).get().to_dict()
+
+    def assert_complete(self, run: dict) -> None:
+        self.assertEqual(run["status"], "done")
+        totals = {t["endpoint"]: t for t in run["totals"]}
+        for name, n in SIZES.items():
+            self.assertEqual(totals[name]["itemsCount"], n, name)
+            self.assertEqual(totals[name]["addedCount"], n, name)
+            manifest = {}
+            for shard in self.db.collection("regfi_snapshots").document(totals[name]["snapshotId"]).collection("manifest").stream():
+                manifest.update(shard.to_dict()["items"])
+            self.assertEqual(len(manifest), n, name)
+            self.assertEqual(len(list(self.db.collection(totals[name]["collection"]).stream())), n, name)
+
+    def test_crash_mid_part_resumes_from_checkpoint(self) -> None:
+        # 4 commits de BATCH por segmento: el 7º cae a mitad del segundo
+        self.db = CrashingFirestore("regfi_cultivos", fail_at=7)
+        run_id = main.plan_run(main.ENDPOINTS)
+
+        run = self.run_doc(run_id)
+        self.assertEqual(run["status"], "running")
+        part = self.db.collection("regfi_runs").document(run_id).collection("parts").document("cultivos").get().to_dict()
+        self.assertEqual(part["status"], "error")
+        snap_id = run["parts"]["cultivos"]
+        state = self.snapshot(snap_id)
+        self.assertEqual(state["cursor"], SHARD)
+        self.assertGreater(state["resume"]["chars"], 0)
+        self.assertEqual(self.post_calls, 0)
+
+        # Reintento de Cloud Tasks: misma tarea
+        main.run_part({"runId": run_id, "endpoint": "cultivos", "snapshotId": snap_id, "cursor": 0, "step": 0})
+
+        self.assert_complete(self.run_doc(run_id))
+        metrics = self.snapshot(snap_id)["metrics"]
+        self.assertEqual([(m["outcome"], m["counters"]["items"]) for m in metrics], [
+            ("error", SHARD), ("done", SIZES["cultivos"] - SHARD),
+        ])
+        resumed = metrics[-1]
+        self.assertIn("archiveRead", resumed["stagesSec"])  # sin volver a descargar
+        self.assertNotIn("resumeSkip", resumed["stagesSec"])  # por posición, sin re-parsear lo hecho
+        self.assertEqual(self.fetches.count("cultivos"), 1)
+        self.assertEqual(self.post_calls, 1)
+
+        # Otra parte que termine tarde (o un reintento) no vuelve a finalizar
+        self.assertFalse(main._maybe_finalize_run(self.db, self.db.collection("regfi_runs").document(run_id)))
+        self.assertIsNone(main.finalize_run({"runId": run_id}))
+        self.assertEqual(self.post_calls, 1)
+
+    def test_budget_checked_per_batch(self) -> None:
+        main.TASK_BUDGET_SEC = -1  # vencido desde el principio: un batch por invocación
+        run_id = main.plan_run(main.ENDPOINTS)
+
+        run = self.run_doc(run_id)
+        self.assert_complete(run)
+        self.assertEqual(self.post_calls, 1)
+        self.assertEqual(sorted(self.fetches), sorted(SIZES))
+        snap_id = run["parts"]["productos"]
+        metrics = self.snapshot(snap_id)["metrics"]
+        # La 1ª invocación solo descarga y archiva; luego un batch por invocación
+        self.assertNotIn("items", metrics[0]["counters"])
+        items = [m["counters"].get("items", 0) for m in metrics[1:]]
+        self.assertEqual(max(items), BATCH)
+        self.assertEqual(sum(items), SIZES["productos"])
+
+        # Un reintento tardío de un tramo ya re-encolado no repite trabajo
+        writes = self.db.writes
+        self.assertIsNone(main.run_part({"runId": run_id, "endpoint": "productos", "snapshotId": snap_id, "cursor": 0, "step": 0}))
+        self.assertEqual(self.db.writes, writes)
+
+    def test_failed_finalize_is_retried(self) -> None:
+        build_cross_views = main.build_cross_views
+        calls = []
+
+        def flaky_cross_views(db, product_ids, collection):
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError("deadline exceeded")
+            return build_cross_views(db, product_ids, collection)
+
+        with mock.patch.object(main, "build_cross_views", flaky_cross_views):
+            run_id = main.plan_run(main.ENDPOINTS)
+            self.assertEqual(self.run_doc(run_id)["status"], "error")
+
+            main.finalize_run({"runId": run_id})  # reintento de Cloud Tasks
+
+        run = self.run_doc(run_id)
+        self.assert_complete(run)
+        self.assertEqual(run["finalizeAttempts"], 2)
+        self.assertIn("crossViews", run["post"])
+
+    def search_current(self) -> dict:
+        return self.db.collection("regfi_search").document("current").get().to_dict()
+
+    def test_search_index_rebuilds_only_dirty_parts(self) -> None:
+        main.plan_run(main.ENDPOINTS)
+        current = self.search_current()
+        self.assertEqual(sorted(current["rebuiltParts"]), sorted(SIZES))
+        self.assertEqual(current["docsCount"], sum(SIZES.values()))
+
+        self.versions["cultivos"] = 1
+        main.plan_run(main.ENDPOINTS)
+        current = self.search_current()
+        self.assertEqual(current["rebuiltParts"], ["cultivos"])
+        self.assertEqual(current["docsCount"], sum(SIZES.values()))
+        index = main._SearchIndex(json.loads(zlib.decompress(b"".join(
+            d.to_dict()["blob"] for d in sorted(
+                self.db.collection("regfi_search").document(current["version"]).collection("shards").stream(),
+                key=lambda d: d.id,
+            )
+        ))))
+        self.assertEqual(index.search("cultivos v1", {}, None, 5)[0], SIZES["cultivos"])
+        self.assertEqual(index.search("cultivos v0", {}, None, 5)[0], 0)
+        self.assertEqual(index.search("formulados v0", {}, None, 5)[0], SIZES["formulados"])
+
+    def test_failed_search_index_keeps_parts_dirty(self) -> None:
+        search_part = main._search_part
+
+        def failing_search_part(db, ep):
+            if ep["name"] == "cultivos":
+                raise RuntimeError("deadline exceeded")
+            return search_part(db, ep)
+
+        with mock.patch.object(main, "_search_part", failing_search_part):
+            run_id = main.plan_run(main.ENDPOINTS)
+        self.assertEqual(self.run_doc(run_id)["status"], "done")  # el índice no bloquea la ejecución
+        self.assertIsNone(self.search_current())
+
+        summary = main.rebuild_search_index()  # reintento (o la tarea de la próxima ejecución)
+        self.assertEqual(summary["rebuiltParts"], ["cultivos"])
+        self.assertEqual(summary["docsCount"], sum(SIZES.values()))
+
+    def test_legacy_docs_tombstoned_on_first_run(self) -> None:
+        # Como los dejaba la versión anterior: ID sha1, sin huella ni manifiesto
+        col = self.db.collection("regfi_productos")
+        legacy = [{"NumRegistro": i, "Nombre": f"antiguo {i}"} for i in range(50)]
+        for item in legacy:
+            col.document(main._hash_doc_id(item)).set({"snapshotId": "old", "lastSeenAt": "2024-01-01", "data": item})
+        self.db.collection("regfi_snapshots").document("old").set({
+            "createdAt": "2024-01-01", "endpoint": "productos", "itemsCount": 50, "finalizedAt": "2024-01-01",
+        })
+
+        run = self.run_doc(main.plan_run(main.ENDPOINTS))
+        totals = {t["endpoint"]: t for t in run["totals"]}
+        self.assertEqual(totals["productos"]["removedCount"], len(legacy))
+        live = [d for d in col.stream() if not d.to_dict().get("removedAt")]
+        self.assertEqual(len(live), SIZES["productos"])
+        self.assertEqual(self.search_current()["docsCount"], sum(SIZES.values()))
+
+        # Solo la primera vez: después el diff es contra el manifiesto
+        self.versions["productos"] = 1
+        run = self.run_doc(main.plan_run(main.ENDPOINTS))
+        totals = {t["endpoint"]: t for t in run["totals"]}
+        self.assertEqual((totals["productos"]["changedCount"], totals["productos"]["removedCount"]), (SIZES["productos"], 0))
+
+    def view(self, collection: str, slug: str) -> dict:
+        ref = self.db.collection(collection).document(slug)
+        root = ref.get().to_dict()
+        productos, por_plaga = {}, {}
+        for i in range(root["pages"]):
+            page = ref.collection("pages").document(f"{i:03d}").get().to_dict()
+            productos.update(page["productos"])
+            for plaga, pids in page.get("porPlaga", {}).items():
+                por_plaga.setdefault(plaga, []).extend(pids)
+        return {**root, "productos": productos, "porPlaga": por_plaga}
+
+    def test_cross_views_paged_and_caught_up(self) -> None:
+        main.VIEW_PAGE_BYTES = 20_000
+        self.addCleanup(setattr, main, "VIEW_PAGE_BYTES", 500_000)
+        with mock.patch.object(main, "build_cross_views", side_effect=RuntimeError("deadline exceeded")):
+            totals, errors = main.run_snapshot(main.ENDPOINTS)
+        self.assertEqual(errors, [])
+        self.assertIsNone(self.db.collection("regfi_view_cultivos").document("vid").get().to_dict())
+
+        # La siguiente ejecución (productos sin cambios) aplica también el snapshot pendiente
+        main.run_snapshot(main.ENDPOINTS)
+        vid = self.view("regfi_view_cultivos", "vid")
+        self.assertGreater(vid["pages"], 1)
+        self.assertEqual(vid["productosCount"], SIZES["productos"])
+        self.assertEqual(len(vid["productos"]), SIZES["productos"])
+        self.assertEqual(len(vid["porPlaga"]["oidio-3"]), len(range(3, SIZES["productos"], 7)))
+        self.assertEqual(self.view("regfi_view_sustancias", "azufre")["productosCount"], SIZES["productos"])
+
+        # Productos que desaparecen: la vista se vuelve a paginar y sobran páginas
+        pages = vid["pages"]
+        SIZES["productos"], size = 300, SIZES["productos"]
+        self.addCleanup(SIZES.__setitem__, "productos", size)
+        self.versions["productos"] = 1
+        main.run_snapshot(main.ENDPOINTS)
+        vid = self.view("regfi_view_cultivos", "vid")
+        self.assertLess(vid["pages"], pages)
+        self.assertEqual(len(vid["productos"]), 300)
+        ref = self.db.collection("regfi_view_cultivos").document("vid").collection("pages")
+        self.assertEqual(len(list(ref.stream())), vid["pages"])
+
+    def test_raw_archives_pruned_per_endpoint(self) -> None:
+        main.RAW_KEEP = 2
+        self.addCleanup(setattr, main, "RAW_KEEP", 4)
+        for version in range(3):
+            self.versions = dict.fromkeys(SIZES, version)
+            main.plan_run(main.ENDPOINTS)
+        archives = [d.to_dict() for d in self.db.collection("regfi_raw").stream()]
+        self.assertEqual(sorted(a["endpoint"] for a in archives), sorted(list(SIZES) * 2))
+        chunks = [p for p in self.db._docs if p.startswith("regfi_raw/") and "/chunks/" in p]
+        self.assertEqual(len(chunks), sum(a["chunks"] for a in archives))
+        # El último snapshot de cada endpoint sigue pudiendo reanudarse desde su archivo
+        last = main._last_snapshot(self.db, main._endpoint_by_name("productos"))
+        self.assertIsNotNone(main.load_raw_export(self.db, last.to_dict()["rawSnapshotId"]))
+
+if __name__ == "__main__":
+    unittest.main()
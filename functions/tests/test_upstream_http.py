@@ -0,0 +1,74 @@
+"""
+Sessions hacia MAPA/AEMET contra un servidor HTTP local (sin red): las respuestas de
+error de un export en streaming devuelven su conexión al pool.
+
+Uso (desde functions/, con el venv de las functions activado):
+    python -m unittest discover -s tests
+"""
+from __future__ import annotations
+
+import json
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+import requests  # noqa: E402
+
+import main  # noqa: E402
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive: la conexión vuelve al pool de verdad
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        status = int(self.path.strip("/").split("?")[0] or 200)
+        body = json.dumps({"Contenido": [{"Nombre": "x"}]} if status == 200 else {"error": status}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FetchExportErrorsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+        self.http = {"pool": 2, "timeout": (2, 2), "retries": 1, "backoff": 0}
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        main._sessions.pop(f"127.0.0.1:{self.server.server_port}", None)
+
+    def ep(self, status: int) -> dict:
+        return {"name": "t", "url": f"{self.base}/{status}", "method": "GET", "http": self.http}
+
+    def free_connections(self) -> int:
+        """Huecos libres del pool de conexiones de la Session (urllib3 crea uno por host)."""
+        url = self.base + "/"
+        pools = main._http_session(url).get_adapter(url).poolmanager.pools
+        (key,) = pools.keys()
+        return pools[key].pool.qsize()
+
+    def test_error_response_returns_connection(self) -> None:
+        for status in (403, 503, 403, 503, 403):  # más fallos que conexiones en el pool
+            with self.assertRaises(requests.HTTPError):
+                main.fetch_export(self.ep(status))
+            self.assertEqual(self.free_connections(), self.http["pool"])
+        raw = main.fetch_export(self.ep(200))
+        self.assertEqual(json.loads("".join(raw.text()))["Contenido"][0]["Nombre"], "x")
+        self.assertEqual(self.free_connections(), self.http["pool"])
+
+
+if __name__ == "__main__":
+    unittest.main()